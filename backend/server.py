@@ -1,27 +1,557 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query
+from fastapi import FastAPI, APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import httpx
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReadPreference, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo import monitoring
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, EmailStr, ConfigDict, ValidationError
+from typing import List, Optional, Tuple
 import uuid
-from datetime import datetime, timezone
+import json
+import csv
+import io
+import codecs
+import base64
+import binascii
+import hashlib
+import hmac
+import random
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from enum import Enum
+from functools import lru_cache
+from contextlib import asynccontextmanager
+import bisect
+import math
+from collections import OrderedDict
+import re
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used without it
+    orjson = None
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # optional; responses are gzip-compressed without it
+    BrotliMiddleware = None
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # optional; only needed when request profiling is turned on
+    Profiler = None
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+
+# ============= METRICS =============
+# Labels are route templates, not raw paths, and a fixed set of Mongo command names,
+# so series counts stay bounded. With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR
+# so /metrics aggregates all of them.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+MONGO_COMMANDS = {
+    "find", "getMore", "insert", "update", "delete", "findAndModify", "aggregate",
+    "count", "distinct", "createIndexes", "listIndexes", "explain",
+}
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests handled", ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route"], buckets=LATENCY_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", ["method", "route"], multiprocess_mode="livesum"
+)
+MONGO_LATENCY = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command latency", ["collection", "command"], buckets=MONGO_BUCKETS
+)
+MONGO_FAILURES = Counter(
+    "mongodb_command_failures_total", "MongoDB commands that returned an error", ["collection", "command"]
+)
+HTTP_REJECTED = Counter(
+    "http_requests_rejected_total", "Requests turned away before reaching a route", ["method", "route", "reason"]
+)
+WRITE_BEHIND_DEPTH = Gauge(
+    "write_behind_buffer_depth", "Submissions acknowledged but not yet flushed", ["buffer"], multiprocess_mode="livesum"
+)
+WRITE_BEHIND_FLUSH_LATENCY = Histogram(
+    "write_behind_flush_duration_seconds", "Time to flush one write-behind batch", ["buffer"], buckets=MONGO_BUCKETS
+)
+WRITE_BEHIND_FLUSHED = Counter(
+    "write_behind_flushed_total", "Submissions flushed from a write-behind buffer", ["buffer", "outcome"]
+)
+WRITE_BEHIND_REJECTED = Counter(
+    "write_behind_rejected_total", "Submissions turned away because the buffer stayed full", ["buffer"]
+)
+
+
+# Short single-document and query commands, as served on the request path. Aggregations
+# (rollup rebuilds with $out), explains and export getMores are slow by design and would
+# hold the load-shedding signal up long after the database recovered.
+SHED_SIGNAL_COMMANDS = {"find", "insert", "update", "delete", "findAndModify", "count"}
+
+
+class LatencyAverage:
+    """
+    Exponentially weighted moving average of recent latencies, in seconds. Without new
+    samples it decays toward zero with time constant decay_seconds, so a quiet spell
+    after a slow command doesn't keep it high.
+    """
+    
+    def __init__(self, weight: float = 0.05, decay_seconds: float = 5.0):
+        self.weight = weight
+        self.decay_seconds = decay_seconds
+        self._value = 0.0
+        self._updated = time.monotonic()
+    
+    @property
+    def value(self) -> float:
+        return self._value * math.exp(-(time.monotonic() - self._updated) / self.decay_seconds)
+    
+    def observe(self, seconds: float):
+        value = self.value
+        self._value = value + self.weight * (seconds - value)
+        self._updated = time.monotonic()
+
+mongo_latency = LatencyAverage()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Time every command this process sends, labelled by collection and command name."""
+    
+    def __init__(self):
+        self._pending = {}
+    
+    def started(self, event):
+        command = event.command_name if event.command_name in MONGO_COMMANDS else "other"
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else "-"
+        self._pending[(event.connection_id, event.request_id)] = (collection, command)
+    
+    def succeeded(self, event):
+        labels = self._pending.pop((event.connection_id, event.request_id), None)
+        if event.command_name in SHED_SIGNAL_COMMANDS:
+            mongo_latency.observe(event.duration_micros / 1e6)
+        if labels:
+            MONGO_LATENCY.labels(*labels).observe(event.duration_micros / 1e6)
+    
+    def failed(self, event):
+        labels = self._pending.pop((event.connection_id, event.request_id), None)
+        if event.command_name in SHED_SIGNAL_COMMANDS:
+            mongo_latency.observe(event.duration_micros / 1e6)
+        if labels:
+            MONGO_LATENCY.labels(*labels).observe(event.duration_micros / 1e6)
+            MONGO_FAILURES.labels(*labels).inc()
+
+
+class MetricsMiddleware:
+    """Request count, latency and in-flight gauge per route template."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    @staticmethod
+    def route_template(scope) -> str:
+        partial = None
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+            if match == Match.PARTIAL and partial is None:
+                partial = route.path
+        return partial or "unmatched"
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        method = scope["method"]
+        route = scope["route_template"] = self.route_template(scope)
+        status = 500
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        in_flight = HTTP_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_LATENCY.labels(method, route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(method, route, str(status)).inc()
+            in_flight.dec()
+
+
+def metrics_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+# ============= RATE LIMITING =============
+# Unauthenticated write routes that RATE_LIMITS can throttle per client IP
+RATE_LIMITED_ROUTES = {
+    "contact": ("POST", "/api/contact"),
+    "newsletter": ("POST", "/api/newsletter/subscribe"),
+    "lessons": ("POST", "/api/lessons/register"),
+    "orders": ("POST", "/api/orders"),
+}
+# Shed first when the server is busy or Mongo slows down, so checkout keeps its capacity
+LOW_PRIORITY_ROUTES = {
+    RATE_LIMITED_ROUTES["contact"], RATE_LIMITED_ROUTES["newsletter"], RATE_LIMITED_ROUTES["lessons"],
+}
+
+
+def parse_rate_limits(spec: str) -> dict:
+    """Parse "contact=5/60,orders=20/60" into {(method, route): (burst, tokens per second)}."""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = entry.partition('=')
+        requests, _, seconds = rate.partition('/')
+        if name.strip() not in RATE_LIMITED_ROUTES:
+            raise ValueError(f"RATE_LIMITS: unknown route {name.strip()!r}")
+        limits[RATE_LIMITED_ROUTES[name.strip()]] = (int(requests), int(requests) / float(seconds or 1))
+    return limits
+
+
+class TokenBuckets:
+    """
+    One token bucket per key, in an LRU-ordered dict capped at max_entries.
+
+    A flood from many addresses evicts the least recently seen clients instead of
+    growing without bound; an evicted client simply starts again with a full bucket.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+    
+    def take(self, key, capacity: int, rate: float) -> float:
+        """Spend a token for key; returns 0 if one was available, else seconds until one is."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class LoadShedder:
+    """
+    Global cap on requests in flight in this worker.
+
+    Low-priority routes are only admitted while fewer than low_priority_share of the
+    cap are in use and the recent Mongo command latency is under mongo_latency_limit;
+    everything else is admitted up to the cap. A cap of 0 disables shedding.
+    """
+    
+    def __init__(self, max_concurrent: int, low_priority_share: float, mongo_latency_limit: float):
+        self.max_concurrent = max_concurrent
+        self.low_priority_limit = max(1, int(max_concurrent * low_priority_share))
+        self.mongo_latency_limit = mongo_latency_limit
+        self.in_flight = 0
+    
+    def admit(self, route: Tuple[str, str]) -> bool:
+        if not self.max_concurrent:
+            return True
+        if route in LOW_PRIORITY_ROUTES:
+            return self.in_flight < self.low_priority_limit and mongo_latency.value < self.mongo_latency_limit
+        return self.in_flight < self.max_concurrent
+
+
+class RateLimitMiddleware:
+    """Token buckets per client IP and route, then load shedding, ahead of the routes."""
+    
+    def __init__(self, app, limits: dict, buckets: TokenBuckets, shedder: LoadShedder,
+                 trust_forwarded_for: bool = False):
+        self.app = app
+        self.limits = limits
+        self.buckets = buckets
+        self.shedder = shedder
+        self.trust_forwarded_for = trust_forwarded_for
+    
+    def client_ip(self, scope) -> str:
+        if self.trust_forwarded_for:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    # The last hop is the one our own proxy appended; earlier ones are client-supplied
+                    return value.decode("latin-1").rsplit(",", 1)[-1].strip()
+        client = scope.get("client")
+        return client[0] if client else "-"
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        route = (scope["method"], scope.get("route_template") or MetricsMiddleware.route_template(scope))
+        limit = self.limits.get(route)
+        if limit:
+            wait = self.buckets.take((route, self.client_ip(scope)), *limit)
+            if wait:
+                HTTP_REJECTED.labels(*route, "rate_limited").inc()
+                response = JSONResponse(
+                    {"detail": "Too many requests"}, status_code=429, headers={"Retry-After": str(math.ceil(wait))}
+                )
+                await response(scope, receive, send)
+                return
+        
+        if not self.shedder.admit(route):
+            HTTP_REJECTED.labels(*route, "shed").inc()
+            response = JSONResponse(
+                {"detail": "Server busy, please retry shortly"}, status_code=503, headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        
+        self.shedder.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.shedder.in_flight -= 1
+
+
+# ============= PROFILING =============
+# Off unless one of these is set, in which case the middleware isn't installed at all
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS or PROFILE_TOKEN)
+
+
+class ProfilingMiddleware:
+    """
+    Profile selected requests with pyinstrument and save them as speedscope JSON.
+
+    A request is profiled when it falls in the sample_rate sample, or carries an X-Profile
+    header equal to token (its response then names the file in X-Profile-Id). With
+    slow_ms set, every request is profiled and kept if it took at least that long.
+    Only the newest max_files profiles are kept in directory.
+    """
+    
+    def __init__(self, app, directory: Path, sample_rate: float = 0, slow_ms: float = 0,
+                 token: Optional[str] = None, max_files: int = 200, interval: float = 0.001):
+        self.app = app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_ms / 1000
+        self.token = token.encode() if token else None
+        self.max_files = max_files
+        self.interval = interval
+    
+    def requested(self, scope) -> bool:
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                return hmac.compare_digest(value, self.token)
+        return False
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        requested = self.token is not None and self.requested(scope)
+        sampled = random.random() < self.sample_rate
+        if not (requested or sampled or self.slow_seconds):
+            await self.app(scope, receive, send)
+            return
+        
+        route = scope.get("route_template") or MetricsMiddleware.route_template(scope)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        name = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{scope['method']}-{slug}-{uuid.uuid4().hex[:8]}"
+        
+        async def send_wrapper(message):
+            if requested and message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-Id", name)
+            await send(message)
+        
+        profiler = Profiler(interval=self.interval, async_mode="enabled")
+        profiler.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            session = profiler.stop()
+            elapsed = time.perf_counter() - started
+            if requested or sampled or elapsed >= self.slow_seconds:
+                # Rendering and rotation happen off the event loop, after the response went out
+                await asyncio.to_thread(self.save, session, f"{name}-{elapsed * 1000:.0f}ms")
+    
+    def save(self, session, name: str):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            (self.directory / f"{name}.speedscope.json").write_text(SpeedscopeRenderer().render(session))
+            profiles = sorted(self.directory.glob("*.speedscope.json"), key=lambda path: path.stat().st_mtime)
+            for old in profiles[:-self.max_files]:
+                old.unlink(missing_ok=True)
+        except OSError as e:
+            logger.error(f"Could not save profile {name}: {e}")
+
+
+# ============= DATABASE =============
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+class Mongo:
+    """
+    Owns the Motor client. Nothing is read from the environment or created at import time:
+    the client is built on first use, and the app lifespan pings it at startup so the
+    first request doesn't pay for server selection and the initial connection.
+    
+    `db` is the primary-routed database used for writes, admin reads and cache refills;
+    `public_db` is the same database with MONGO_PUBLIC_READ_PREFERENCE (primary unless set),
+    used by the uncached public event and search reads.
+    """
+    
+    def __init__(self):
+        self._client = None
+        self._db = None
+        self._public_db = None
+        self.transactions = False  # set by warm_up on a replica set or sharded cluster
+    
+    @property
+    def client(self) -> AsyncIOMotorClient:
+        if self._client is None:
+            self.use_client(self._create_client())
+        return self._client
+    
+    @property
+    def db(self):
+        self.client
+        return self._db
+    
+    @property
+    def public_db(self):
+        self.client
+        return self._public_db
+    
+    @staticmethod
+    def _create_client() -> AsyncIOMotorClient:
+        options = {
+            "tz_aware": True,
+            "event_listeners": [MongoCommandMetrics()],
+            "appname": "kashoe-api",
+            "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+            "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+            "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000')),
+            "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+            "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000')),
+            "socketTimeoutMS": int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '30000')),
+        }
+        compressors = os.environ.get('MONGO_COMPRESSORS')
+        if compressors:
+            options["compressors"] = compressors
+        return AsyncIOMotorClient(os.environ['MONGO_URL'], **options)
+    
+    def use_client(self, client):
+        """Install a client, e.g. an in-memory stand-in for tools and tests."""
+        read_preference = READ_PREFERENCES[os.environ.get('MONGO_PUBLIC_READ_PREFERENCE', 'primary')]
+        self._client = client
+        self._db = client[os.environ['DB_NAME']]
+        self._public_db = client.get_database(os.environ['DB_NAME'], read_preference=read_preference)
+    
+    async def warm_up(self):
+        started = time.perf_counter()
+        try:
+            hello = await self.client.admin.command("hello")
+        except Exception as e:
+            logger.error(f"MongoDB warm-up ping failed: {e}")
+            return
+        self.transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        logger.info(f"MongoDB reachable in {(time.perf_counter() - started) * 1000:.0f} ms")
+    
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = self._db = self._public_db = None
+
+mongo = Mongo()
+
+
+class DatabaseProxy:
+    """Module-level handle that resolves to the current database on each use."""
+    
+    def __init__(self, resolve):
+        self._resolve = resolve
+    
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+    
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+db = DatabaseProxy(lambda: mongo.db)
+public_db = DatabaseProxy(lambda: mongo.public_db)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await mongo.warm_up()
+    await ensure_indexes(db)
+    mpesa_callback_queue.start()
+    typeahead_index.start()
+    archiver.start()
+    event_status_updater.start()
+    order_expiry.start()
+    for buffer in write_behind_buffers.values():
+        buffer.start()
+    try:
+        yield
+    finally:
+        # Flush acknowledged submissions while the Mongo client is still open
+        await asyncio.gather(*(buffer.stop() for buffer in write_behind_buffers.values()))
+        await mpesa_callback_queue.stop()
+        await typeahead_index.stop()
+        await archiver.stop()
+        await event_status_updater.stop()
+        await order_expiry.stop()
+        await daraja.close()
+        mongo.close()
+
 
 # Create the main app without a prefix
-app = FastAPI(title="Kashoe Chess Club API")
+app = FastAPI(title="Kashoe Chess Club API", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -53,6 +583,10 @@ class EventStatus(str, Enum):
     COMPLETED = "completed"
     CANCELLED = "cancelled"
 
+class EventRegistrationStatus(str, Enum):
+    CONFIRMED = "confirmed"
+    WAITLISTED = "waitlisted"
+
 
 # ============= MODELS =============
 
@@ -111,6 +645,29 @@ class EventCreate(BaseModel):
     max_participants: Optional[int] = None
 
 
+# Event Registration Models
+class EventRegistration(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    event_id: str
+    participant_name: str
+    parent_name: Optional[str] = None
+    email: EmailStr
+    phone: str
+    age: Optional[int] = None
+    status: EventRegistrationStatus = EventRegistrationStatus.CONFIRMED
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class EventRegistrationCreate(BaseModel):
+    participant_name: str
+    parent_name: Optional[str] = None
+    email: EmailStr
+    phone: str
+    age: Optional[int] = None
+    waitlist: bool = False  # join the waitlist instead of failing when the event is full
+
+
 # Lesson Registration Models
 class LessonRegistration(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -144,6 +701,7 @@ class OrderItem(BaseModel):
     product_name: str
     quantity: int
     price: float
+    category: Optional[ProductCategory] = None
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -156,14 +714,22 @@ class Order(BaseModel):
     total_amount: float
     status: OrderStatus = OrderStatus.PENDING
     mpesa_reference: Optional[str] = None
+    mpesa_checkout_request_id: Optional[str] = None  # the latest STK push
+    mpesa_checkout_request_ids: List[str] = []  # every STK push; any of them may be the one paid
+    stock_reserved: bool = False  # orders placed before checkout reserved stock have none to give back
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class OrderItemCreate(BaseModel):
+    product_id: str
+    quantity: int = Field(gt=0)
+
 class OrderCreate(BaseModel):
     customer_name: str
     customer_email: EmailStr
     customer_phone: str
-    items: List[OrderItem]
-    total_amount: float
+    items: List[OrderItemCreate] = Field(min_length=1)
+    # Accepted for older clients but ignored; the total is recomputed from current prices
+    total_amount: Optional[float] = None
 
 
 # Contact Models
@@ -198,6 +764,1815 @@ class NewsletterSubscription(BaseModel):
 class NewsletterSubscriptionCreate(BaseModel):
     email: EmailStr
 
+class NewsletterImportResult(BaseModel):
+    new: int
+    reactivated: int
+    already_active: int
+    invalid: int
+
+
+# Search Models
+class SearchResults(BaseModel):
+    products: List[Product]
+    events: List[Event]
+
+class TypeaheadSuggestion(BaseModel):
+    kind: str  # "product" or "event"
+    id: str
+    label: str
+
+
+# Analytics Models
+class SalesRollup(BaseModel):
+    day: datetime
+    category: str
+    revenue: float
+    units: int
+    orders: int
+
+class SalesReport(BaseModel):
+    rows: List[SalesRollup]
+    revenue: float
+    units: int
+
+
+# Pagination Models
+class ProductPage(BaseModel):
+    items: List[Product]
+    next_cursor: Optional[str] = None
+
+class EventPage(BaseModel):
+    items: List[Event]
+    next_cursor: Optional[str] = None
+
+class EventRegistrationPage(BaseModel):
+    items: List[EventRegistration]
+    next_cursor: Optional[str] = None
+
+class LessonRegistrationPage(BaseModel):
+    items: List[LessonRegistration]
+    next_cursor: Optional[str] = None
+
+class OrderPage(BaseModel):
+    items: List[Order]
+    next_cursor: Optional[str] = None
+
+class ContactSubmissionPage(BaseModel):
+    items: List[ContactSubmission]
+    next_cursor: Optional[str] = None
+
+
+# Bulk Models
+class BulkItemError(BaseModel):
+    index: int
+    detail: str
+
+class ProductBulkResult(BaseModel):
+    inserted: List[Product]
+    errors: List[BulkItemError]
+
+class EventBulkResult(BaseModel):
+    inserted: List[Event]
+    errors: List[BulkItemError]
+
+class OrderStatusFilter(BaseModel):
+    status: Optional[OrderStatus] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+
+class OrderStatusBulkUpdate(BaseModel):
+    status: OrderStatus
+    ids: Optional[List[str]] = None
+    filter: Optional[OrderStatusFilter] = None
+
+class LessonStatusFilter(BaseModel):
+    status: Optional[LessonStatus] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+
+class LessonStatusBulkUpdate(BaseModel):
+    status: LessonStatus
+    ids: Optional[List[str]] = None
+    filter: Optional[LessonStatusFilter] = None
+
+class StatusBulkResult(BaseModel):
+    matched: int
+    modified: int
+    rejected: int
+    not_found: int
+
+
+# ============= PAGINATION =============
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(sort_value, doc_id: str) -> str:
+    """Build an opaque cursor from the last row's sort key and id."""
+    if isinstance(sort_value, datetime):
+        sort_value = {"$date": sort_value.isoformat()}
+    payload = json.dumps([sort_value, doc_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[object, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, doc_id = json.loads(base64.urlsafe_b64decode(padded))
+        if isinstance(sort_value, dict):
+            sort_value = datetime.fromisoformat(sort_value["$date"])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return sort_value, doc_id
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Read a naive query datetime as UTC, so it compares with tz-aware ones and stored dates."""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def add_date_range(query: dict, field: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    """Restrict query to start <= field < end; either bound may be omitted."""
+    bounds = {}
+    if start:
+        bounds["$gte"] = as_utc(start)
+    if end:
+        bounds["$lt"] = as_utc(end)
+    if bounds:
+        query[field] = bounds
+    return query
+
+async def paginate(collection, query: dict, sort_field: str, limit: int, cursor: Optional[str] = None,
+                   projection: Optional[dict] = None, archive=None):
+    """
+    Keyset pagination over (sort_field, id), newest first.
+    Each page is a bounded range scan instead of a skip over earlier rows. With an
+    archive collection, the same range is read from both and merged.
+    """
+    if cursor:
+        sort_value, doc_id = decode_cursor(cursor)
+        query = {"$and": [query, {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": doc_id}},
+        ]}]}
+    
+    def read(source):
+        return source.find(query, projection or {"_id": 0}).sort(
+            [(sort_field, -1), ("id", -1)]
+        ).limit(limit + 1).to_list(limit + 1)
+    
+    if archive is None:
+        docs = await read(collection)
+    else:
+        hot, archived = await asyncio.gather(read(collection), read(archive))
+        # Keyed by id so a document caught mid-move by the archiver is listed once
+        merged = {doc["id"]: doc for doc in archived + hot}.values()
+        docs = sorted(merged, key=lambda doc: (doc[sort_field], doc["id"]), reverse=True)[:limit + 1]
+    
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1][sort_field], docs[-1]["id"])
+    
+    return docs, next_cursor
+
+
+# ============= STORAGE =============
+# Datetime fields are stored as native BSON dates; older documents may still hold ISO strings
+# until scripts/migrate_dates.py has been run.
+DATE_FIELDS = {
+    "products": ["created_at"],
+    "events": ["event_date", "created_at"],
+    "event_registrations": ["created_at"],
+    "orders": ["created_at"],
+    "lesson_registrations": ["created_at"],
+    "contact_submissions": ["created_at"],
+    "newsletter_subscriptions": ["subscribed_at"],
+    "sales_daily": ["day"],
+}
+
+
+# ============= FAST RESPONSES =============
+# Routes listed in FAST_RESPONSE_ROUTES (or "*" for all) skip response_model validation:
+# rows read from the DB were validated on the way in, so they are projected to the
+# model's fields and encoded directly, with orjson when it is installed.
+FAST_RESPONSE_ROUTES = {
+    route.strip() for route in os.environ.get('FAST_RESPONSE_ROUTES', '').split(',') if route.strip()
+}
+
+
+def fast_response_enabled(route: str) -> bool:
+    return "*" in FAST_RESPONSE_ROUTES or route in FAST_RESPONSE_ROUTES
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode()
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+    
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+@lru_cache(maxsize=None)
+def model_projection(model) -> dict:
+    return {"_id": 0, **{name: 1 for name in model.model_fields}}
+
+@lru_cache(maxsize=None)
+def model_defaults(model) -> dict:
+    return {
+        name: field.default for name, field in model.model_fields.items()
+        if not field.is_required() and field.default_factory is None
+    }
+
+def trusted_rows(model, docs: List[dict]) -> List[dict]:
+    """Fill in defaults for fields that older documents were written without."""
+    defaults = model_defaults(model)
+    return [{**defaults, **doc} for doc in docs]
+
+def created_response(route: str, obj: BaseModel, doc: dict):
+    """Return the document just inserted instead of validating and dumping obj a second time."""
+    if not fast_response_enabled(route):
+        return obj
+    doc.pop("_id", None)  # added by insert_one
+    return FastJSONResponse(doc)
+
+def sparse_projection(model, fields: Optional[str], sort_field: str) -> Optional[dict]:
+    """
+    Turn a `fields=name,price` parameter into a projection. id and the sort field are
+    always included because the page cursor is built from them.
+    """
+    if not fields:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested - set(model.model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return {"_id": 0, "id": 1, sort_field: 1, **{field: 1 for field in requested}}
+
+async def list_page(route: str, model, collection, query: dict, sort_field: str, limit: int,
+                    cursor: Optional[str], fields: Optional[str] = None, include_archived: bool = False):
+    archive = archive_of(collection) if include_archived else None
+    projection = sparse_projection(model, fields, sort_field)
+    if projection:
+        # Partial rows can't satisfy response_model, so they are always encoded directly
+        docs, next_cursor = await paginate(collection, query, sort_field, limit, cursor, projection, archive)
+        return FastJSONResponse({"items": docs, "next_cursor": next_cursor})
+    
+    if not fast_response_enabled(route):
+        docs, next_cursor = await paginate(collection, query, sort_field, limit, cursor, archive=archive)
+        return {"items": docs, "next_cursor": next_cursor}
+    
+    docs, next_cursor = await paginate(collection, query, sort_field, limit, cursor, model_projection(model), archive)
+    return FastJSONResponse({"items": trusted_rows(model, docs), "next_cursor": next_cursor})
+
+
+# ============= INDEXES =============
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL', str(24 * 60 * 60)))
+
+# Every filter/sort combination used by the routes below must be backed by one of these.
+INDEXES = {
+    "products": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("is_active", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("name", TEXT), ("description", TEXT)], weights={"name": 5, "description": 1}),
+    ],
+    "events": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("event_date", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("event_date", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("title", TEXT), ("description", TEXT), ("location", TEXT)],
+                   weights={"title": 5, "location": 2, "description": 1}),
+    ],
+    "event_registrations": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("event_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("event_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("mpesa_checkout_request_id", ASCENDING)], sparse=True),
+        IndexModel([("mpesa_checkout_request_ids", ASCENDING)], sparse=True),
+        IndexModel([("paid_batch_id", ASCENDING)], sparse=True),
+        IndexModel([("status_batch_id", ASCENDING)], sparse=True),
+    ],
+    "sales_daily": [
+        IndexModel([("day", ASCENDING), ("category", ASCENDING)], unique=True),
+    ],
+    "lesson_registrations": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "contact_submissions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "newsletter_subscriptions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    "mpesa_callbacks": [
+        IndexModel([("processed_at", ASCENDING), ("received_at", ASCENDING)]),
+    ],
+    "idempotency_keys": [
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS),
+    ],
+    "events_archive": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("event_date", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("event_date", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "orders_archive": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "contact_submissions_archive": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+}
+
+# (route, collection, filter, sort) for every query the API issues, used by the plan report
+PAGE_SORT_CREATED = [("created_at", DESCENDING), ("id", DESCENDING)]
+PAGE_SORT_EVENT_DATE = [("event_date", DESCENDING), ("id", DESCENDING)]
+
+QUERY_SHAPES = [
+    ("GET /api/products", "products", {"is_active": True}, PAGE_SORT_CREATED),
+    ("GET /api/products?category=", "products", {"is_active": True, "category": ProductCategory.CHESS_BOARD.value}, PAGE_SORT_CREATED),
+    ("GET /api/products/{id}", "products", {"id": ""}, None),
+    ("GET /api/events", "events", {}, PAGE_SORT_EVENT_DATE),
+    ("GET /api/events?status=", "events", {"status": EventStatus.UPCOMING.value}, PAGE_SORT_EVENT_DATE),
+    ("GET /api/events/{id}", "events", {"id": ""}, None),
+    ("GET /api/events/calendar", "events", {"event_date": {"$gte": datetime(2026, 1, 1, tzinfo=timezone.utc), "$lt": datetime(2026, 2, 1, tzinfo=timezone.utc)}}, [("event_date", ASCENDING), ("id", ASCENDING)]),
+    ("GET /api/events/next", "events", {"status": EventStatus.UPCOMING.value, "event_date": {"$gte": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, [("event_date", ASCENDING), ("id", ASCENDING)]),
+    ("Event status updater", "events", {"status": {"$in": [EventStatus.UPCOMING.value, EventStatus.ONGOING.value]}, "event_date": {"$lte": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, None),
+    ("GET /api/search (products)", "products", {"$text": {"$search": "chess"}, "is_active": True}, None),
+    ("GET /api/search (events)", "events", {"$text": {"$search": "chess"}}, None),
+    ("POST /api/events/{id}/register", "events", {"id": "", "status": EventStatus.UPCOMING.value}, None),
+    ("GET /api/events/{id}/registrations", "event_registrations", {"event_id": ""}, PAGE_SORT_CREATED),
+    ("GET /api/events/{id}/registrations?status=", "event_registrations", {"event_id": "", "status": EventRegistrationStatus.CONFIRMED.value}, PAGE_SORT_CREATED),
+    ("GET /api/lessons/registrations", "lesson_registrations", {}, PAGE_SORT_CREATED),
+    ("GET /api/lessons/registrations?status=", "lesson_registrations", {"status": LessonStatus.PENDING.value}, PAGE_SORT_CREATED),
+    ("PATCH /api/lessons/registrations/{id}/status", "lesson_registrations", {"id": ""}, None),
+    ("GET /api/orders", "orders", {}, PAGE_SORT_CREATED),
+    ("GET /api/orders?status=", "orders", {"status": OrderStatus.PENDING.value}, PAGE_SORT_CREATED),
+    ("GET /api/orders/{id}", "orders", {"id": ""}, None),
+    ("POST /api/orders", "products", {"id": {"$in": [""]}, "is_active": True}, None),
+    ("GET /api/contact/submissions", "contact_submissions", {}, PAGE_SORT_CREATED),
+    ("POST /api/newsletter/subscribe", "newsletter_subscriptions", {"email": ""}, None),
+    ("M-Pesa callback worker", "orders", {"$or": [{"mpesa_checkout_request_ids": {"$in": [""]}}, {"mpesa_checkout_request_id": {"$in": [""]}}]}, None),
+    ("M-Pesa callback rollups", "orders", {"paid_batch_id": ""}, None),
+    ("PATCH /api/orders/status", "orders", {"status": {"$in": [OrderStatus.PAID.value, OrderStatus.PROCESSING.value]}, "created_at": {"$gte": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, None),
+    ("PATCH /api/orders/status (rollups)", "orders", {"status_batch_id": ""}, None),
+    ("Unpaid order expiry", "orders", {"status": OrderStatus.PENDING.value, "created_at": {"$lt": datetime(2026, 1, 1, tzinfo=timezone.utc)}, "stock_reserved": True}, None),
+    ("PATCH /api/lessons/registrations/status", "lesson_registrations", {"status": {"$in": [LessonStatus.PENDING.value]}, "created_at": {"$gte": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, None),
+    ("GET /api/admin/analytics/sales", "sales_daily", {"day": {"$gte": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, [("day", ASCENDING), ("category", ASCENDING)]),
+    ("M-Pesa callback replay", "mpesa_callbacks", {"processed_at": None}, [("received_at", ASCENDING)]),
+    ("GET /api/events?include_archived=true", "events_archive", {}, PAGE_SORT_EVENT_DATE),
+    ("GET /api/orders?include_archived=true", "orders_archive", {}, PAGE_SORT_CREATED),
+    ("GET /api/orders/{id}?include_archived=true", "orders_archive", {"id": ""}, None),
+    ("GET /api/contact/submissions?include_archived=true", "contact_submissions_archive", {}, PAGE_SORT_CREATED),
+    ("Archiver (events)", "events", {"status": {"$in": [EventStatus.COMPLETED.value, EventStatus.CANCELLED.value]}, "event_date": {"$lt": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, [("event_date", ASCENDING), ("id", ASCENDING)]),
+    ("Archiver (orders)", "orders", {"status": {"$in": [OrderStatus.DELIVERED.value, OrderStatus.CANCELLED.value]}, "created_at": {"$lt": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("Archiver (contact submissions)", "contact_submissions", {"created_at": {"$lt": datetime(2026, 1, 1, tzinfo=timezone.utc)}}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+]
+
+
+async def ensure_indexes(database):
+    """
+    Create the declared indexes one at a time, so one that can't be built (say, a text
+    index clashing with an existing one) doesn't hold back the rest. Existing indexes with
+    the same spec are a no-op.
+    """
+    for collection_name, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                await database[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                # e.g. duplicate values blocking a unique index; keep serving and surface it
+                logger.error(f"Could not create index {index.document['name']} on {collection_name}: {e}")
+
+def _plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+async def explain_query_shapes(database) -> List[dict]:
+    """Run explain() for every route's query shape and flag collection scans."""
+    report = []
+    for route, collection_name, query, sort in QUERY_SHAPES:
+        cursor = database[collection_name].find(query, {"_id": 0})
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.limit(1).explain()
+        stages = _plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "route": route,
+            "collection": collection_name,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages,
+        })
+    return report
+
+
+# ============= CACHE =============
+class CatalogCache:
+    """
+    In-process cache of serialized product responses, keyed by query.
+
+    Catalog writes through this worker bump the version and drop every entry. Stock
+    changes from checkout only drop the entries that show those products' stock. The TTL
+    bounds how long other workers can serve a catalog that changed under them.
+    """
+    
+    def __init__(self, ttl_seconds: float, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.version = 0
+        self._entries = {}
+        self._stock_keys = {}  # product id -> keys of the entries showing its stock
+        self._stock_changes = 0
+        self._stock_changed_at = {}  # product id -> _stock_changes at its last stock change
+    
+    def checkpoint(self) -> Tuple[int, int]:
+        """Taken before reading an entry's data from Mongo and handed back to put()."""
+        return self.version, self._stock_changes
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, etag, body = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return etag, body
+    
+    def put(self, key, body: bytes, checkpoint: Tuple[int, int], stock_ids=()):
+        """Cache body under key; stock_ids are the products whose stock it shows."""
+        version, stock_changes = checkpoint
+        # From the body alone, so every worker gives the same response the same tag
+        etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        # A write landed while this entry was being built; serve it but don't keep it
+        stale = version != self.version or any(
+            self._stock_changed_at.get(product_id, 0) > stock_changes for product_id in stock_ids
+        )
+        if not stale:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+                self._stock_keys.clear()
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, etag, body)
+            for product_id in stock_ids:
+                self._stock_keys.setdefault(product_id, set()).add(key)
+        return etag, body
+    
+    def invalidate(self):
+        self.version += 1
+        self._entries.clear()
+        self._stock_keys.clear()
+        self._stock_changed_at.clear()
+    
+    def invalidate_stock(self, product_ids):
+        self._stock_changes += 1
+        for product_id in product_ids:
+            self._stock_changed_at[product_id] = self._stock_changes
+            for key in self._stock_keys.pop(product_id, ()):
+                self._entries.pop(key, None)
+
+catalog_cache = CatalogCache(ttl_seconds=float(os.environ.get('CATALOG_CACHE_TTL', '60')))
+
+
+def cached_json_response(entry, request: Request) -> Response:
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# ============= IDEMPOTENCY =============
+IDEMPOTENCY_WAIT_SECONDS = 10.0
+IDEMPOTENCY_LOCK_SECONDS = 60.0
+
+IdempotencyKey = Header(None, alias="Idempotency-Key", min_length=1, max_length=255)
+
+
+async def run_idempotent(key: Optional[str], scope: str, payload: BaseModel, handler):
+    """
+    Run handler() at most once per Idempotency-Key.
+
+    The first request claims the key by inserting its record; the response is stored on it
+    when the handler finishes. Retries with the same key replay that response, and
+    duplicates that arrive while the first is still running wait for it instead of
+    running the handler again. If the handler fails the claim is dropped so a retry can
+    try again. Records expire after IDEMPOTENCY_TTL_SECONDS.
+    """
+    if key is None:
+        return await handler()
+    
+    record_id = f"{scope}:{key}"
+    fingerprint = hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    
+    while True:
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": record_id,
+                "fingerprint": fingerprint,
+                "body": None,
+                "created_at": datetime.now(timezone.utc),
+            })
+            break
+        except DuplicateKeyError:
+            pass
+        
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record is None:
+            continue  # the first attempt failed and released the key
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if record["body"] is not None:
+            return Response(content=record["body"], media_type="application/json",
+                            headers={"Idempotent-Replayed": "true"})
+        if record["created_at"] < datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS):
+            # The worker that claimed the key died mid-request; let this one take over
+            await db.idempotency_keys.delete_one({"_id": record_id, "body": None, "created_at": record["created_at"]})
+            continue
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    
+    try:
+        result = await handler()
+    except BaseException:
+        await db.idempotency_keys.delete_one({"_id": record_id})
+        raise
+    
+    body = result.model_dump_json().encode()
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$set": {"body": body, "completed_at": datetime.now(timezone.utc)}}
+    )
+    return Response(content=body, media_type="application/json")
+
+
+# ============= DARAJA =============
+class DarajaNotConfigured(Exception):
+    pass
+
+
+class DarajaClient:
+    """
+    Shared client for the Safaricom Daraja API.
+
+    One pooled keep-alive connection set is reused for every call, the OAuth token is
+    cached until token_refresh_margin seconds before it expires and refreshed by a single
+    caller while the others wait on the lock, and at most max_concurrency requests are
+    in flight at once.
+    """
+    
+    def __init__(self, base_url: str, consumer_key: Optional[str], consumer_secret: Optional[str],
+                 shortcode: Optional[str], passkey: Optional[str], callback_url: Optional[str],
+                 callback_token: Optional[str] = None, timeout: float = 10.0, max_concurrency: int = 20, token_refresh_margin: float = 60.0):
+        self.base_url = base_url.rstrip("/")
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.callback_token = callback_token
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.token_refresh_margin = token_refresh_margin
+        self._http = None
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(max_concurrency)
+    
+    @property
+    def configured(self) -> bool:
+        return all([self.consumer_key, self.consumer_secret, self.shortcode, self.passkey, self.callback_url,
+                    self.callback_token])
+    
+    @property
+    def callback_endpoint(self) -> str:
+        """Where Safaricom posts results: the callback route with our secret as the last segment."""
+        return f"{self.callback_url.rstrip('/')}/{self.callback_token}"
+    
+    def valid_callback_token(self, token: str) -> bool:
+        if not self.callback_token:
+            return False
+        return hmac.compare_digest(token.encode(), self.callback_token.encode())
+    
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+        return self._http
+    
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
+    async def access_token(self) -> str:
+        if self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+        
+        async with self._token_lock:
+            # Another caller may have refreshed it while this one waited
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            
+            response = await self.http.get(
+                "/oauth/v1/generate",
+                params={"grant_type": "client_credentials"},
+                auth=(self.consumer_key, self.consumer_secret)
+            )
+            response.raise_for_status()
+            data = response.json()
+            self._token = data["access_token"]
+            self._token_expires_at = time.monotonic() + max(
+                float(data.get("expires_in", 3599)) - self.token_refresh_margin, 0
+            )
+            return self._token
+    
+    def invalidate_token(self):
+        self._token = None
+        self._token_expires_at = 0.0
+    
+    async def stk_push(self, phone_number: str, amount: int, account_reference: str, description: str) -> dict:
+        if not self.configured:
+            raise DarajaNotConfigured()
+        
+        timestamp = datetime.now(ZoneInfo("Africa/Nairobi")).strftime("%Y%m%d%H%M%S")
+        password = base64.b64encode(f"{self.shortcode}{self.passkey}{timestamp}".encode()).decode()
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": self.callback_endpoint,
+            "AccountReference": account_reference[:12],
+            "TransactionDesc": description[:13],
+        }
+        
+        async with self._slots:
+            for attempt in range(2):
+                token = await self.access_token()
+                response = await self.http.post(
+                    "/mpesa/stkpush/v1/processrequest",
+                    json=payload,
+                    headers={"Authorization": f"Bearer {token}"}
+                )
+                # A token revoked before its advertised expiry; fetch a new one once
+                if response.status_code == 401 and attempt == 0:
+                    self.invalidate_token()
+                    continue
+                response.raise_for_status()
+                return response.json()
+
+daraja = DarajaClient(
+    base_url=os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke'),
+    consumer_key=os.environ.get('MPESA_CONSUMER_KEY'),
+    consumer_secret=os.environ.get('MPESA_CONSUMER_SECRET'),
+    shortcode=os.environ.get('MPESA_SHORTCODE'),
+    passkey=os.environ.get('MPESA_PASSKEY'),
+    callback_url=os.environ.get('MPESA_CALLBACK_URL'),
+    callback_token=os.environ.get('MPESA_CALLBACK_TOKEN'),
+    timeout=float(os.environ.get('MPESA_TIMEOUT', '10')),
+    max_concurrency=int(os.environ.get('MPESA_MAX_CONCURRENCY', '20')),
+)
+
+
+def normalize_msisdn(phone_number: str) -> str:
+    """Turn 07XXXXXXXX / +2547XXXXXXXX / 2547XXXXXXXX into the 2547XXXXXXXX form Daraja expects."""
+    digits = "".join(ch for ch in phone_number if ch.isdigit())
+    if digits.startswith("0") and len(digits) == 10:
+        digits = "254" + digits[1:]
+    elif len(digits) == 9:
+        digits = "254" + digits
+    if not (digits.startswith("254") and len(digits) == 12):
+        raise HTTPException(status_code=400, detail="Invalid phone number")
+    return digits
+
+
+# ============= M-PESA CALLBACKS =============
+MPESA_SUCCESS = 0
+# A callback can beat the STK push response that links its CheckoutRequestID to the order;
+# keep unmatched callbacks in the inbox this long before giving up on them
+MPESA_UNMATCHED_GRACE_SECONDS = 600
+
+
+def parse_stk_callback(payload: dict) -> dict:
+    """Pull the fields we act on out of a Daraja STK callback body."""
+    callback = payload.get("Body", {}).get("stkCallback", {})
+    metadata = {
+        item.get("Name"): item.get("Value")
+        for item in callback.get("CallbackMetadata", {}).get("Item", [])
+    }
+    return {
+        "checkout_request_id": callback.get("CheckoutRequestID"),
+        "result_code": callback.get("ResultCode"),
+        "result_desc": callback.get("ResultDesc"),
+        "receipt": metadata.get("MpesaReceiptNumber"),
+        "amount": metadata.get("Amount"),
+    }
+
+
+class MpesaCallbackQueue:
+    """
+    Applies persisted M-Pesa callbacks to orders in the background.
+
+    The callback route only writes to the mpesa_callbacks inbox and enqueues the id, so
+    Safaricom is acked at once. A bounded pool of workers drains the queue in batches,
+    one orders bulk_write per batch. Anything that did not make it through the queue
+    (full queue, crash, restart) is still unprocessed in the inbox and is picked up by
+    the replay sweep, which runs at startup and then every sweep_interval seconds.
+    """
+    
+    def __init__(self, workers: int, max_queued: int = 1000, batch_size: int = 100,
+                 sweep_interval: float = 30.0):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.sweep_interval = sweep_interval
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self._tasks = []
+    
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def submit(self, checkout_request_id: str):
+        try:
+            self.queue.put_nowait(checkout_request_id)
+        except asyncio.QueueFull:
+            pass  # left unprocessed in the inbox for the next sweep
+    
+    async def replay(self, older_than: float = 0):
+        """Enqueue every unprocessed inbox entry received more than older_than seconds ago."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than)
+        cursor = db.mpesa_callbacks.find(
+            {"processed_at": None, "received_at": {"$lte": cutoff}}, {"_id": 1}
+        ).sort("received_at", ASCENDING)
+        async for doc in cursor:
+            await self.queue.put(doc["_id"])
+    
+    async def _sweep(self):
+        older_than = 0
+        while True:
+            try:
+                await self.replay(older_than)
+            except Exception as e:
+                logger.error(f"M-Pesa callback replay failed: {e}")
+            older_than = self.sweep_interval
+            await asyncio.sleep(self.sweep_interval)
+    
+    async def _work(self):
+        while True:
+            batch = {await self.queue.get()}
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.add(self.queue.get_nowait())
+            try:
+                await apply_mpesa_callbacks(list(batch))
+            except Exception as e:
+                # Still unprocessed in the inbox; the next sweep retries them
+                logger.error(f"Applying {len(batch)} M-Pesa callbacks failed: {e}")
+
+mpesa_callback_queue = MpesaCallbackQueue(workers=int(os.environ.get('MPESA_CALLBACK_WORKERS', '4')))
+
+
+async def apply_mpesa_callbacks(checkout_request_ids: List[str]):
+    callbacks = await db.mpesa_callbacks.find(
+        {"_id": {"$in": checkout_request_ids}, "processed_at": None}
+    ).to_list(len(checkout_request_ids))
+    if not callbacks:
+        return
+    
+    ids = [callback["_id"] for callback in callbacks]
+    batch_id = str(uuid.uuid4())
+    # Orders placed before every push was kept only carry the single latest id
+    orders = await db.orders.find(
+        {"$or": [{"mpesa_checkout_request_ids": {"$in": ids}}, {"mpesa_checkout_request_id": {"$in": ids}}]},
+        {"_id": 0, "id": 1, "mpesa_checkout_request_id": 1, "mpesa_checkout_request_ids": 1,
+         "total_amount": 1, "status": 1}
+    ).to_list(None)
+    orders_by_checkout = {}
+    for order in orders:
+        for checkout_request_id in [order.get("mpesa_checkout_request_id"), *order.get("mpesa_checkout_request_ids", [])]:
+            if checkout_request_id:
+                orders_by_checkout[checkout_request_id] = order
+    
+    now = datetime.now(timezone.utc)
+    give_up_before = now - timedelta(seconds=MPESA_UNMATCHED_GRACE_SECONDS)
+    operations = []
+    processed = []
+    for callback in callbacks:
+        order = orders_by_checkout.get(callback["_id"])
+        if order is None:
+            if callback["received_at"] < give_up_before:
+                logger.warning(f"M-Pesa callback {callback['_id']} does not match any order")
+                processed.append(callback["_id"])
+            continue
+        
+        processed.append(callback["_id"])
+        if callback["result_code"] != MPESA_SUCCESS:
+            continue  # the customer can retry; with ORDER_EXPIRY_INTERVAL set, order_expiry cancels it later
+        if order["status"] == OrderStatus.CANCELLED:
+            logger.warning(f"M-Pesa callback {callback['_id']} paid order {order['id']} after it was cancelled; refund it")
+            continue
+        if not isinstance(callback["amount"], (int, float)) or callback["amount"] < order["total_amount"]:
+            logger.warning(
+                f"M-Pesa callback {callback['_id']} paid {callback['amount']} for order {order['id']} "
+                f"totalling {order['total_amount']}; left pending"
+            )
+            continue
+        
+        # Only pending orders move to paid, so a replayed callback is a no-op
+        operations.append(UpdateOne(
+            {"id": order["id"], "status": OrderStatus.PENDING},
+            {"$set": {"status": OrderStatus.PAID, "mpesa_reference": callback["receipt"], "paid_batch_id": batch_id}}
+        ))
+    
+    if operations:
+        await db.orders.bulk_write(operations, ordered=False)
+        # Tagging with the batch id tells us exactly which orders this batch moved to paid
+        paid = await db.orders.find(
+            {"paid_batch_id": batch_id}, {"_id": 0, "items": 1, "created_at": 1}
+        ).to_list(len(operations))
+        await update_sales_rollups(paid, 1)
+    
+    if processed:
+        await db.mpesa_callbacks.update_many(
+            {"_id": {"$in": processed}},
+            {"$set": {"processed_at": now}}
+        )
+
+
+# ============= SEARCH =============
+TYPEAHEAD_EVENT_STATUSES = [EventStatus.UPCOMING, EventStatus.ONGOING]
+TYPEAHEAD_REFRESH_SECONDS = float(os.environ.get('TYPEAHEAD_REFRESH', '60'))
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize_search_text(text: str) -> str:
+    return " ".join(_WORD.findall(text.lower()))
+
+
+class TypeaheadIndex:
+    """
+    In-memory prefix index over active product names and upcoming event titles.
+
+    Every word-start suffix of a label is a key ("digital chess clock", "chess clock",
+    "clock"), kept in one sorted list, so a lookup is a bisect plus a short scan and never
+    touches the database. Writes through this worker rebuild it in the background; the
+    periodic refresh picks up writes made through other workers.
+    """
+    
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self._keys = []
+        self._entries = []
+        self._dirty = False
+        self._rebuild_task = None
+        self._refresh_task = None
+    
+    def lookup(self, query: str, limit: int) -> List[dict]:
+        prefix = normalize_search_text(query)
+        if not prefix:
+            return []
+        
+        results = []
+        seen = set()
+        position = bisect.bisect_left(self._keys, prefix)
+        while position < len(self._keys) and self._keys[position].startswith(prefix):
+            entry = self._entries[position]
+            if entry["id"] not in seen:
+                seen.add(entry["id"])
+                results.append(entry)
+                if len(results) >= limit:
+                    break
+            position += 1
+        return results
+    
+    async def rebuild(self):
+        # From the primary: a rebuild follows a write, which a secondary may not have yet
+        products = await db.products.find(
+            {"is_active": True}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+        events = await db.events.find(
+            {"status": {"$in": TYPEAHEAD_EVENT_STATUSES}}, {"_id": 0, "id": 1, "title": 1}
+        ).to_list(None)
+        
+        pairs = []
+        for kind, docs, field in (("product", products, "name"), ("event", events, "title")):
+            for doc in docs:
+                entry = {"kind": kind, "id": doc["id"], "label": doc[field]}
+                words = normalize_search_text(doc[field]).split()
+                pairs.extend((" ".join(words[i:]), entry) for i in range(len(words)))
+        pairs.sort(key=lambda pair: pair[0])
+        
+        # Swap both lists in at once so lookups never see a half-built index
+        self._keys, self._entries = [key for key, _ in pairs], [entry for _, entry in pairs]
+    
+    def invalidate(self):
+        """Schedule a rebuild; writes that land while one is running trigger one more."""
+        self._dirty = True
+        if self._rebuild_task is None or self._rebuild_task.done():
+            self._rebuild_task = asyncio.create_task(self._rebuild_while_dirty())
+    
+    async def _rebuild_while_dirty(self):
+        while self._dirty:
+            self._dirty = False
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logger.error(f"Typeahead index rebuild failed: {e}")
+                return
+    
+    def start(self):
+        self._refresh_task = asyncio.create_task(self._refresh())
+    
+    async def stop(self):
+        for task in (self._refresh_task, self._rebuild_task):
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(
+            *(task for task in (self._refresh_task, self._rebuild_task) if task is not None),
+            return_exceptions=True
+        )
+    
+    async def _refresh(self):
+        while True:
+            self.invalidate()
+            await asyncio.sleep(self.refresh_seconds)
+
+typeahead_index = TypeaheadIndex(refresh_seconds=TYPEAHEAD_REFRESH_SECONDS)
+
+
+async def text_search(collection, query: dict, limit: int) -> List[dict]:
+    return await collection.find(
+        query, {"_id": 0, "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(limit)
+
+
+# ============= STOCK =============
+def merge_order_lines(items: List[OrderItemCreate]) -> dict:
+    """Collapse repeated products into one line so each is reserved once."""
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return quantities
+
+async def price_order_lines(quantities: dict) -> List[OrderItem]:
+    """Load every ordered product in one $in query and price the lines from the catalog."""
+    products = await db.products.find(
+        {"id": {"$in": list(quantities)}, "is_active": True},
+        {"_id": 0, "id": 1, "name": 1, "price": 1, "stock": 1, "category": 1}
+    ).to_list(len(quantities))
+    by_id = {product["id"]: product for product in products}
+    
+    missing = [product_id for product_id in quantities if product_id not in by_id]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Products not available: {', '.join(missing)}")
+    
+    short = [by_id[product_id]["name"] for product_id, quantity in quantities.items()
+             if by_id[product_id].get("stock", 0) < quantity]
+    if short:
+        raise HTTPException(status_code=409, detail=f"Insufficient stock: {', '.join(short)}")
+    
+    return [
+        OrderItem(product_id=product_id, product_name=by_id[product_id]["name"],
+                  quantity=quantity, price=by_id[product_id]["price"], category=by_id[product_id].get("category"))
+        for product_id, quantity in quantities.items()
+    ]
+
+def _take_stock(line: OrderItem) -> Tuple[dict, dict]:
+    """Filter and update that take a line's quantity, matching only while enough is left."""
+    return {"id": line.product_id, "stock": {"$gte": line.quantity}}, {"$inc": {"stock": -line.quantity}}
+
+async def _reserve_in_transaction(lines: List[OrderItem]) -> Optional[OrderItem]:
+    async with await mongo.client.start_session() as session:
+        async with session.start_transaction():
+            result = await db.products.bulk_write(
+                [UpdateOne(*_take_stock(line)) for line in lines], ordered=True, session=session
+            )
+            if result.matched_count == len(lines):
+                return None
+            await session.abort_transaction()
+    
+    # Nothing was taken; read the stock back only to name the line that came up short
+    products = await db.products.find(
+        {"id": {"$in": [line.product_id for line in lines]}}, {"_id": 0, "id": 1, "stock": 1}
+    ).to_list(None)
+    stock = {product["id"]: product.get("stock", 0) for product in products}
+    return next((line for line in lines if stock.get(line.product_id, 0) < line.quantity), lines[0])
+
+async def _reserve_one_by_one(lines: List[OrderItem]) -> Optional[OrderItem]:
+    for taken, line in enumerate(lines):
+        result = await db.products.update_one(*_take_stock(line))
+        if not result.matched_count:
+            await release_stock(lines[:taken])
+            return line
+    return None
+
+async def reserve_stock(lines: List[OrderItem]):
+    """
+    Decrement stock for every line, or not at all.
+
+    Each update only matches while stock >= quantity, and an unknown product never
+    matches. On a replica set the updates are one bulk_write in a transaction that is
+    aborted unless every line matched. A standalone server has no transactions, so there
+    the lines are taken one at a time and those already taken are put back when a line
+    comes up short.
+    """
+    try:
+        if mongo.transactions:
+            short = await _reserve_in_transaction(lines)
+        else:
+            short = await _reserve_one_by_one(lines)
+    finally:
+        catalog_cache.invalidate_stock({line.product_id for line in lines})
+    if short is not None:
+        raise HTTPException(status_code=409, detail=f"Insufficient stock: {short.product_name}")
+
+async def release_stock(lines: List[OrderItem]):
+    if not lines:
+        return
+    await db.products.bulk_write([
+        UpdateOne({"id": line.product_id}, {"$inc": {"stock": line.quantity}})
+        for line in lines
+    ], ordered=False)
+    catalog_cache.invalidate_stock({line.product_id for line in lines})
+
+async def restock_orders(orders: List[dict]):
+    """Give back the stock held by orders that were just cancelled, one update per product."""
+    quantities = {}
+    for order in orders:
+        if not order.get("stock_reserved"):
+            continue
+        for item in order["items"]:
+            quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    await release_stock([
+        OrderItem(product_id=product_id, product_name="", quantity=quantity, price=0)
+        for product_id, quantity in quantities.items()
+    ])
+
+
+# ============= EVENT CAPACITY =============
+async def claim_event_seat(event_id: str) -> bool:
+    """
+    Take one seat with a single conditional increment.
+    The capacity check and the increment happen in the same document update, so
+    concurrent sign-ups can never push current_participants past max_participants.
+    """
+    result = await db.events.update_one(
+        {
+            "id": event_id,
+            "status": EventStatus.UPCOMING,
+            "$or": [
+                {"max_participants": None},
+                {"$expr": {"$lt": ["$current_participants", "$max_participants"]}},
+            ],
+        },
+        {"$inc": {"current_participants": 1}}
+    )
+    return result.modified_count == 1
+
+async def release_event_seat(event_id: str):
+    await db.events.update_one(
+        {"id": event_id, "current_participants": {"$gt": 0}},
+        {"$inc": {"current_participants": -1}}
+    )
+
+
+# ============= BACKGROUND JOBS =============
+class PeriodicJob:
+    """Runs job() every interval seconds from start() until stop(); an interval of 0 disables it."""
+    
+    def __init__(self, name: str, interval: float, job):
+        self.name = name
+        self.interval = interval
+        self.job = job
+        self._task = None
+    
+    def start(self):
+        if self.interval:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.job()
+            except Exception as e:
+                logger.error(f"{self.name} failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# ============= EVENT STATUS =============
+# Events only carry a start time, so an event counts as ongoing for this long after it
+EVENT_DURATION = timedelta(hours=float(os.environ.get('EVENT_DURATION_HOURS', '8')))
+EVENT_STATUS_INTERVAL_SECONDS = float(os.environ.get('EVENT_STATUS_INTERVAL', '60'))
+CALENDAR_MAX_DAYS = 366
+NEXT_EVENTS_MAX = 20
+
+
+async def advance_event_statuses(database, now: Optional[datetime] = None) -> int:
+    """
+    Move events along upcoming -> ongoing -> completed as their dates pass.
+    Two update_many calls on the (status, event_date) index, however many events changed;
+    an event whose ongoing window passed between runs goes straight to completed.
+    """
+    now = now or datetime.now(timezone.utc)
+    completed = await database.events.update_many(
+        {"status": {"$in": [EventStatus.UPCOMING, EventStatus.ONGOING]}, "event_date": {"$lte": now - EVENT_DURATION}},
+        {"$set": {"status": EventStatus.COMPLETED}}
+    )
+    started = await database.events.update_many(
+        {"status": EventStatus.UPCOMING, "event_date": {"$lte": now}},
+        {"$set": {"status": EventStatus.ONGOING}}
+    )
+    return completed.modified_count + started.modified_count
+
+
+async def update_event_statuses():
+    if await advance_event_statuses(db):
+        # Completed events drop out of the typeahead
+        typeahead_index.invalidate()
+
+event_status_updater = PeriodicJob("Advancing event statuses", EVENT_STATUS_INTERVAL_SECONDS, update_event_statuses)
+
+
+# ============= NEWSLETTER =============
+NEWSLETTER_IMPORT_BATCH_SIZE = 1000
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+def newsletter_upsert(email: str, acked: Optional[dict] = None) -> dict:
+    """
+    Update document that (re)activates a subscription, creating it on first sight.
+    A subscription already acknowledged to the client (acked) is created with its id and date.
+    """
+    return {
+        "$set": {"is_active": True},
+        "$setOnInsert": {
+            "id": acked["id"] if acked else str(uuid.uuid4()),
+            "email": email,
+            "subscribed_at": acked["subscribed_at"] if acked else datetime.now(timezone.utc),
+        },
+    }
+
+async def iter_csv_rows(request: Request):
+    """Parse a CSV request body as it arrives instead of buffering the whole upload."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for row in csv.reader(lines):
+            yield row
+    pending += decoder.decode(b"", final=True)
+    if pending.strip():
+        for row in csv.reader([pending]):
+            yield row
+
+async def upsert_subscribers(emails: set, totals: dict, acked: Optional[dict] = None):
+    """Upsert every email in one bulk_write; acked maps emails to subscriptions already answered."""
+    if not emails:
+        return
+    acked = acked or {}
+    try:
+        result = (await db.newsletter_subscriptions.bulk_write(
+            [UpdateOne({"email": email}, newsletter_upsert(email, acked.get(email)), upsert=True) for email in emails],
+            ordered=False
+        )).bulk_api_result
+    except BulkWriteError as e:
+        # A concurrent subscribe won the race for these emails, so they already exist
+        result = e.details
+        totals["already_active"] += len(result["writeErrors"])
+    totals["new"] += result["nUpserted"]
+    totals["reactivated"] += result["nModified"]
+    totals["already_active"] += result["nMatched"] - result["nModified"]
+
+
+# ============= WRITE-BEHIND =============
+# Public form routes listed here acknowledge each submission once it is validated and
+# write it to Mongo in batches; the rest write synchronously as before
+WRITE_BEHIND_ROUTES = {
+    route.strip() for route in os.environ.get('WRITE_BEHIND_ROUTES', '').split(',') if route.strip()
+}
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '500'))
+WRITE_BEHIND_WINDOW_SECONDS = float(os.environ.get('WRITE_BEHIND_WINDOW_MS', '50')) / 1000
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', '10000'))
+WRITE_BEHIND_SUBMIT_TIMEOUT = float(os.environ.get('WRITE_BEHIND_SUBMIT_TIMEOUT', '2'))
+WRITE_BEHIND_SHUTDOWN_ATTEMPTS = 3
+DUPLICATE_KEY = 11000
+
+
+class WriteBehindBuffer:
+    """
+    Acknowledges submissions at once and writes them to Mongo in batches.
+
+    One flusher task writes a batch when it reaches batch_size, or window seconds after
+    the flusher saw the first submission, whichever comes first. At most max_pending
+    submissions wait in memory; past that, submit() waits for a flush to make room and
+    answers 503 after submit_timeout seconds. A failed flush keeps its batch and retries
+    with backoff, so a Mongo outage turns into backpressure instead of lost writes.
+    stop() drains the buffer before returning.
+    """
+    
+    def __init__(self, name: str, flush, batch_size: int, window: float, max_pending: int,
+                 submit_timeout: float):
+        self.name = name
+        self.batch_size = batch_size
+        self.window = window
+        self.submit_timeout = submit_timeout
+        self._write = flush
+        self._room = asyncio.Semaphore(max_pending)
+        self._pending = []
+        self._arrived = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        self._depth = WRITE_BEHIND_DEPTH.labels(name)
+    
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        self._stopping = True
+        self._arrived.set()
+        self._full.set()
+        if self._task:
+            await self._task
+            self._task = None
+    
+    async def submit(self, doc: dict):
+        if self._task is None or self._stopping:
+            await self._write([doc])
+            return
+        try:
+            await asyncio.wait_for(self._room.acquire(), self.submit_timeout)
+        except asyncio.TimeoutError:
+            WRITE_BEHIND_REJECTED.labels(self.name).inc()
+            raise HTTPException(
+                status_code=503, detail="Too many submissions, please retry shortly", headers={"Retry-After": "1"}
+            )
+        self._pending.append(doc)
+        self._depth.inc()
+        self._arrived.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+    
+    async def flush(self) -> bool:
+        """Write the oldest batch; on failure it stays at the head of the buffer."""
+        batch = self._pending[:self.batch_size]
+        started = time.perf_counter()
+        try:
+            await self._write(batch)
+        except Exception as e:
+            logger.error(f"Flushing {len(batch)} {self.name} submissions failed: {e}")
+            WRITE_BEHIND_FLUSHED.labels(self.name, "retried").inc(len(batch))
+            return False
+        WRITE_BEHIND_FLUSH_LATENCY.labels(self.name).observe(time.perf_counter() - started)
+        WRITE_BEHIND_FLUSHED.labels(self.name, "written").inc(len(batch))
+        self._discard(len(batch))
+        return True
+    
+    def _discard(self, count: int):
+        # Submits only ever append, so the flushed batch is still the head of the list
+        del self._pending[:count]
+        self._depth.dec(count)
+        for _ in range(count):
+            self._room.release()
+    
+    async def _run(self):
+        failures = 0
+        while True:
+            if not self._pending:
+                if self._stopping:
+                    return
+                self._arrived.clear()
+                await self._arrived.wait()
+                continue
+            
+            if len(self._pending) < self.batch_size and not self._stopping:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            
+            if await self.flush():
+                failures = 0
+                continue
+            failures += 1
+            if self._stopping and failures >= WRITE_BEHIND_SHUTDOWN_ATTEMPTS:
+                logger.error(f"Dropping {len(self._pending)} unflushed {self.name} submissions at shutdown")
+                WRITE_BEHIND_FLUSHED.labels(self.name, "dropped").inc(len(self._pending))
+                self._discard(len(self._pending))
+                return
+            await asyncio.sleep(min(0.1 * 2 ** failures, 5))
+
+
+def insert_batch(collection: str):
+    async def flush(docs: List[dict]):
+        try:
+            await db[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # insert_many stamps each doc with its _id, so the rows a failed attempt did
+            # write come back as duplicates on the retry and are already stored
+            rejected = [error for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY]
+            if rejected:
+                logger.error(f"{len(rejected)} {collection} submissions were rejected: {rejected[0]['errmsg']}")
+    return flush
+
+async def upsert_subscriber_batch(docs: List[dict]):
+    totals = {"new": 0, "reactivated": 0, "already_active": 0}
+    acked = {doc["email"]: doc for doc in docs}
+    await upsert_subscribers(set(acked), totals, acked)
+
+write_behind_buffers = {
+    route: WriteBehindBuffer(
+        route, flush,
+        batch_size=WRITE_BEHIND_BATCH_SIZE,
+        window=WRITE_BEHIND_WINDOW_SECONDS,
+        max_pending=WRITE_BEHIND_MAX_PENDING,
+        submit_timeout=WRITE_BEHIND_SUBMIT_TIMEOUT,
+    )
+    for route, flush in (
+        ("contact", insert_batch("contact_submissions")),
+        ("lessons", insert_batch("lesson_registrations")),
+        ("newsletter", upsert_subscriber_batch),
+    )
+    if route in WRITE_BEHIND_ROUTES
+}
+
+
+# ============= SALES ROLLUPS =============
+# Orders in these statuses count as sales in the sales_daily rollup
+SALE_STATUSES = {OrderStatus.PAID, OrderStatus.PROCESSING, OrderStatus.SHIPPED, OrderStatus.DELIVERED}
+
+
+def counts_as_sale(status) -> bool:
+    return status in SALE_STATUSES
+
+def sales_day(created_at: datetime) -> datetime:
+    created_at = created_at.astimezone(timezone.utc)
+    return datetime(created_at.year, created_at.month, created_at.day, tzinfo=timezone.utc)
+
+async def update_sales_rollups(orders: List[dict], sign: int):
+    """Add (sign=1) or remove (sign=-1) orders from the daily per-category rollup in one bulk_write."""
+    if not orders:
+        return
+    
+    # Orders placed before items carried their category need it looked up
+    uncategorized = {item["product_id"] for order in orders for item in order["items"] if not item.get("category")}
+    categories = {}
+    if uncategorized:
+        products = await db.products.find(
+            {"id": {"$in": list(uncategorized)}}, {"_id": 0, "id": 1, "category": 1}
+        ).to_list(len(uncategorized))
+        categories = {product["id"]: product["category"] for product in products}
+    
+    deltas = {}
+    for order in orders:
+        day = sales_day(order["created_at"])
+        seen = set()
+        for item in order["items"]:
+            category = item.get("category") or categories.get(item["product_id"], "unknown")
+            delta = deltas.setdefault((day, category), {"revenue": 0.0, "units": 0, "orders": 0})
+            delta["revenue"] += item["price"] * item["quantity"] * sign
+            delta["units"] += item["quantity"] * sign
+            if category not in seen:
+                delta["orders"] += sign
+                seen.add(category)
+    
+    await db.sales_daily.bulk_write([
+        UpdateOne({"day": day, "category": category}, {"$inc": delta}, upsert=True)
+        for (day, category), delta in deltas.items()
+    ], ordered=False)
+
+async def rebuild_sales_rollups(database):
+    """Recompute sales_daily from every order, hot and archived, with a single aggregation replacing its contents."""
+    sales = {"$match": {"status": {"$in": [status.value for status in SALE_STATUSES]}}}
+    await database.orders.aggregate([
+        sales,
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [sales]}},
+        {"$unwind": "$items"},
+        {"$lookup": {
+            "from": "products",
+            "localField": "items.product_id",
+            "foreignField": "id",
+            "as": "product",
+        }},
+        {"$project": {
+            "order_id": "$id",
+            "day": {"$dateFromParts": {
+                "year": {"$year": "$created_at"},
+                "month": {"$month": "$created_at"},
+                "day": {"$dayOfMonth": "$created_at"},
+            }},
+            "category": {"$ifNull": [
+                "$items.category", {"$ifNull": [{"$arrayElemAt": ["$product.category", 0]}, "unknown"]}
+            ]},
+            "revenue": {"$multiply": ["$items.price", "$items.quantity"]},
+            "units": "$items.quantity",
+        }},
+        # One row per (order, day, category) first, so an order counts once per category
+        {"$group": {
+            "_id": {"order_id": "$order_id", "day": "$day", "category": "$category"},
+            "revenue": {"$sum": "$revenue"},
+            "units": {"$sum": "$units"},
+        }},
+        {"$group": {
+            "_id": {"day": "$_id.day", "category": "$_id.category"},
+            "revenue": {"$sum": "$revenue"},
+            "units": {"$sum": "$units"},
+            "orders": {"$sum": 1},
+        }},
+        {"$project": {
+            "_id": 0,
+            "day": "$_id.day",
+            "category": "$_id.category",
+            "revenue": 1,
+            "units": 1,
+            "orders": 1,
+        }},
+        {"$out": "sales_daily"},
+    ], allowDiskUse=True).to_list(None)
+    await ensure_indexes(database)
+
+
+# ============= BULK =============
+MAX_BULK_SIZE = 1000
+
+
+async def bulk_insert(collection, payload: list, create_model, model):
+    """
+    Validate each item on its own and write the valid ones with one unordered insert_many.
+    Returns (inserted, errors), where errors carry the item's index in the request payload.
+    """
+    if len(payload) > MAX_BULK_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_SIZE} items per request")
+    
+    objects, positions, errors = [], [], []
+    for index, item in enumerate(payload):
+        try:
+            objects.append(model(**create_model.model_validate(item).model_dump()))
+            positions.append(index)
+        except ValidationError as e:
+            errors.append({"index": index, "detail": str(e)})
+    
+    if not objects:
+        return [], errors
+    
+    failed = set()
+    try:
+        await collection.insert_many([obj.model_dump() for obj in objects], ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            failed.add(write_error["index"])
+            errors.append({"index": positions[write_error["index"]], "detail": write_error.get("errmsg", "Write failed")})
+    
+    inserted = [obj for i, obj in enumerate(objects) if i not in failed]
+    errors.sort(key=lambda error: error["index"])
+    return inserted, errors
+
+
+# ============= STATUS TRANSITIONS =============
+# With ORDER_EXPIRY_INTERVAL set, orders still unpaid this long after checkout are cancelled
+# and their stock released. Off by default: the web checkout doesn't send an STK push, so
+# its orders are paid out of band and would all expire.
+PENDING_ORDER_TTL = timedelta(minutes=float(os.environ.get('PENDING_ORDER_TTL_MINUTES', '60')))
+ORDER_EXPIRY_INTERVAL_SECONDS = float(os.environ.get('ORDER_EXPIRY_INTERVAL', '0'))
+
+# Status changes the bulk endpoints allow; a document already in the target status is
+# matched but left as it is
+ORDER_TRANSITIONS = {
+    OrderStatus.PENDING: {OrderStatus.PAID, OrderStatus.CANCELLED},
+    OrderStatus.PAID: {OrderStatus.PROCESSING, OrderStatus.SHIPPED, OrderStatus.CANCELLED},
+    OrderStatus.PROCESSING: {OrderStatus.SHIPPED, OrderStatus.CANCELLED},
+    OrderStatus.SHIPPED: {OrderStatus.DELIVERED},
+    OrderStatus.DELIVERED: set(),
+    OrderStatus.CANCELLED: set(),
+}
+LESSON_TRANSITIONS = {
+    LessonStatus.PENDING: {LessonStatus.APPROVED, LessonStatus.REJECTED},
+    LessonStatus.APPROVED: {LessonStatus.REJECTED},
+    LessonStatus.REJECTED: {LessonStatus.APPROVED},
+}
+
+
+def bulk_status_query(ids: Optional[List[str]], status_filter) -> dict:
+    """Turn a bulk request's ids or filter (exactly one of them) into a query."""
+    if (ids is None) == (status_filter is None):
+        raise HTTPException(status_code=400, detail="Pass either ids or filter")
+    if ids is not None:
+        if len(ids) > MAX_BULK_SIZE:
+            raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_SIZE} ids per request")
+        return {"id": {"$in": ids}}
+    
+    query = {}
+    if status_filter.status:
+        query["status"] = status_filter.status.value
+    add_date_range(query, "created_at", status_filter.created_from, status_filter.created_to)
+    if not query:
+        raise HTTPException(status_code=400, detail="filter needs a status or a date bound")
+    return query
+
+async def apply_order_transitions(orders: List[dict], target):
+    """
+    Keep the sales rollups and stock in step with orders that just moved to target.
+    Each order carries the status it left as previous_status.
+    """
+    moved = [order for order in orders if order["previous_status"] != target]
+    await update_sales_rollups(
+        [order for order in moved if counts_as_sale(target) and not counts_as_sale(order["previous_status"])], 1
+    )
+    await update_sales_rollups(
+        [order for order in moved if counts_as_sale(order["previous_status"]) and not counts_as_sale(target)], -1
+    )
+    if target == OrderStatus.CANCELLED:
+        await restock_orders(moved)
+
+async def bulk_transition(collection, query: dict, target, transitions: dict,
+                          ids: Optional[List[str]] = None, orders: bool = False,
+                          count_rejected: bool = True) -> dict:
+    """
+    Move every document matching query to target in one bulk_write, skipping those whose
+    current status can't make that transition. For orders, each document that changes is
+    tagged with the batch id and the status it left, so the rollups and stock see exactly
+    the orders this call moved. Without count_rejected, rejected is reported as 0 and the
+    extra count query is skipped.
+    """
+    # Documents already at target are matched first, before the updates below move more
+    # documents into target where a later update would match them a second time
+    sources = [target.value] + [
+        status.value for status, targets in transitions.items() if target in targets and status != target
+    ]
+    batch_id = str(uuid.uuid4())
+    operations = []
+    for status in sources:
+        update = {"status": target.value}
+        if orders and status != target.value:
+            update["status_batch_id"] = f"{batch_id}:{status}"
+        operations.append(UpdateMany({"$and": [query, {"status": status}]}, {"$set": update}))
+    result = await collection.bulk_write(operations, ordered=True)
+    
+    if orders and result.modified_count:
+        moved = await collection.find(
+            {"status_batch_id": {"$in": [f"{batch_id}:{status}" for status in sources]}},
+            {"_id": 0, "status_batch_id": 1, "items": 1, "created_at": 1, "stock_reserved": 1}
+        ).to_list(None)
+        for order in moved:
+            order["previous_status"] = order.pop("status_batch_id").rsplit(":", 1)[1]
+        await apply_order_transitions(moved, target)
+    
+    rejected = 0
+    if count_rejected:
+        rejected = await collection.count_documents({"$and": [query, {"status": {"$nin": sources}}]})
+    not_found = 0
+    if ids is not None:
+        not_found = max(0, len(set(ids)) - result.matched_count - rejected)
+    return {
+        "matched": result.matched_count,
+        "modified": result.modified_count,
+        "rejected": rejected,
+        "not_found": not_found,
+    }
+
+async def expire_pending_orders():
+    """
+    Cancel orders left unpaid past PENDING_ORDER_TTL, which gives their stock back.
+    Only orders that reserved stock are expired; older ones are left to the admin.
+    """
+    result = await bulk_transition(
+        db.orders,
+        {"created_at": {"$lt": datetime.now(timezone.utc) - PENDING_ORDER_TTL}, "stock_reserved": True},
+        OrderStatus.CANCELLED,
+        {OrderStatus.PENDING: {OrderStatus.CANCELLED}},
+        orders=True,
+        count_rejected=False
+    )
+    if result["modified"]:
+        logger.info(f"Cancelled {result['modified']} unpaid orders")
+
+order_expiry = PeriodicJob("Expiring unpaid orders", ORDER_EXPIRY_INTERVAL_SECONDS, expire_pending_orders)
+
+
+# ============= EXPORT =============
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_COLUMNS = {
+    "orders": ["id", "created_at", "status", "customer_name", "customer_email", "customer_phone",
+               "total_amount", "mpesa_reference", "items"],
+    "lesson_registrations": ["id", "created_at", "status", "student_name", "parent_name", "email", "phone",
+                             "age", "lesson_type", "preferred_schedule", "message"],
+    "contact_submissions": ["id", "created_at", "name", "email", "phone", "subject", "message"],
+}
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+def _csv_cell(value):
+    value = _export_value(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=_export_value, separators=(",", ":"))
+    return "" if value is None else value
+
+async def stream_export(collections: list, query: dict, columns: List[str], export_format: ExportFormat):
+    """
+    Yield rows straight off the cursor, one batch at a time, newest first within each
+    collection. Memory stays bounded by EXPORT_BATCH_SIZE however large the result is.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    if export_format == ExportFormat.CSV:
+        writer.writerow(columns)
+    
+    rows = 0
+    async for doc in iter_collections(collections, query):
+        if export_format == ExportFormat.CSV:
+            writer.writerow([_csv_cell(doc.get(column)) for column in columns])
+        else:
+            buffer.write(json.dumps(doc, default=_export_value, separators=(",", ":")))
+            buffer.write("\n")
+        rows += 1
+        
+        # Flush once per batch so the client sees bytes before the query finishes
+        if rows % EXPORT_BATCH_SIZE == 0 or rows == 1:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if buffer.tell() or rows == 0:
+        yield buffer.getvalue()
+
+async def iter_collections(collections: list, query: dict):
+    for collection in collections:
+        cursor = collection.find(query, {"_id": 0}).sort(PAGE_SORT_CREATED).batch_size(EXPORT_BATCH_SIZE)
+        async for doc in cursor:
+            yield doc
+
+def export_response(collection_name: str, query: dict, export_format: ExportFormat,
+                    include_archived: bool = False) -> StreamingResponse:
+    if export_format == ExportFormat.CSV:
+        media_type = "text/csv"
+    else:
+        media_type = "application/x-ndjson"
+    filename = f"{collection_name}-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.{export_format.value}"
+    collections = [db[collection_name]]
+    if include_archived:
+        collections.append(archive_of(db[collection_name]))
+    
+    return StreamingResponse(
+        stream_export(collections, query, EXPORT_COLUMNS[collection_name], export_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# ============= ARCHIVE =============
+# Terminal documents older than their policy's age move to <collection>_archive, which
+# reads only consult when asked to with include_archived=true
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('ARCHIVE_INTERVAL', '0'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVE_POLICIES = {
+    # collection: (age field, days kept hot, which documents are finished with)
+    "events": (
+        "event_date", int(os.environ.get('ARCHIVE_EVENTS_AFTER_DAYS', '30')),
+        {"status": {"$in": [EventStatus.COMPLETED.value, EventStatus.CANCELLED.value]}},
+    ),
+    "orders": (
+        "created_at", int(os.environ.get('ARCHIVE_ORDERS_AFTER_DAYS', '90')),
+        {"status": {"$in": [OrderStatus.DELIVERED.value, OrderStatus.CANCELLED.value]}},
+    ),
+    "contact_submissions": (
+        "created_at", int(os.environ.get('ARCHIVE_CONTACT_AFTER_DAYS', '180')),
+        {},
+    ),
+}
+
+
+def archive_of(collection):
+    """The archive collection next to a hot collection, on the same database."""
+    return collection.database[f"{collection.name}_archive"]
+
+def archive_query(collection_name: str, now: datetime) -> dict:
+    field, days, query = ARCHIVE_POLICIES[collection_name]
+    return {**query, field: {"$lt": now - timedelta(days=days)}}
+
+async def archive_batch(database, collection_name: str, query: dict) -> int:
+    """
+    Copy the oldest matching batch to the archive, then delete it from the hot collection.
+
+    Copies keep their _id, so a batch copied by a run that stopped before deleting it
+    comes back as duplicates and is simply deleted this time.
+    """
+    field = ARCHIVE_POLICIES[collection_name][0]
+    hot = database[collection_name]
+    archive = archive_of(hot)
+    docs = await hot.find(query).sort([(field, ASCENDING), ("id", ASCENDING)]).limit(
+        ARCHIVE_BATCH_SIZE
+    ).to_list(ARCHIVE_BATCH_SIZE)
+    if not docs:
+        return 0
+    
+    try:
+        await archive.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+            raise
+    
+    ids = [doc["_id"] for doc in docs]
+    result = await hot.delete_many({"_id": {"$in": ids}, **query})
+    if result.deleted_count < len(ids):
+        # Changed since it was read (an order reopened, say), so it stays hot; drop the copy
+        still_hot = await hot.distinct("_id", {"_id": {"$in": ids}})
+        await archive.delete_many({"_id": {"$in": still_hot}})
+    return result.deleted_count
+
+async def archive_cold_documents(database) -> dict:
+    """Move everything currently past its policy, batch by batch. Returns counts per collection."""
+    now = datetime.now(timezone.utc)
+    moved = {}
+    for collection_name in ARCHIVE_POLICIES:
+        query = archive_query(collection_name, now)
+        moved[collection_name] = 0
+        while True:
+            count = await archive_batch(database, collection_name, query)
+            moved[collection_name] += count
+            if count == 0:
+                break
+    return moved
+
+
+async def archive_in_background():
+    moved = await archive_cold_documents(db)
+    if any(moved.values()):
+        logger.info(f"Archived {moved}")
+
+archiver = PeriodicJob("Archiving", ARCHIVE_INTERVAL_SECONDS, archive_in_background)
+
 
 # ============= ROUTES =============
 
@@ -212,39 +2587,73 @@ async def root():
 async def create_product(product: ProductCreate):
     product_obj = Product(**product.model_dump())
     doc = product_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.products.insert_one(doc)
-    return product_obj
+    catalog_cache.invalidate()
+    typeahead_index.invalidate()
+    return created_response("products", product_obj, doc)
 
-@api_router.get("/products", response_model=List[Product])
+@api_router.post("/products/bulk", response_model=ProductBulkResult)
+async def create_products_bulk(products: List[dict]):
+    inserted, errors = await bulk_insert(db.products, products, ProductCreate, Product)
+    
+    if inserted:
+        catalog_cache.invalidate()
+        typeahead_index.invalidate()
+    return {"inserted": inserted, "errors": errors}
+
+@api_router.get("/products", response_model=ProductPage)
 async def get_products(
+    request: Request,
     category: Optional[ProductCategory] = None,
-    is_active: bool = True
+    is_active: bool = True,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
 ):
-    query = {"is_active": is_active}
-    if category:
-        query["category"] = category
-    
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
+    projection = sparse_projection(Product, fields, "created_at")
+    cache_key = ("products", category, is_active, limit, cursor, tuple(sorted(projection or ())))
+    entry = catalog_cache.get(cache_key)
     
-    for product in products:
-        if isinstance(product['created_at'], str):
-            product['created_at'] = datetime.fromisoformat(product['created_at'])
+    if entry is None:
+        # Refills read the primary: right after an invalidation a secondary may still hold
+        # the old catalog, which would then be cached under the new version for the full TTL
+        checkpoint = catalog_cache.checkpoint()
+        query = {"is_active": is_active}
+        if category:
+            query["category"] = category
+        
+        if projection:
+            products, next_cursor = await paginate(db.products, query, "created_at", limit, cursor, projection)
+            body = dumps({"items": products, "next_cursor": next_cursor})
+        elif fast_response_enabled("products"):
+            products, next_cursor = await paginate(db.products, query, "created_at", limit, cursor,
+                                                   model_projection(Product))
+            body = dumps({"items": trusted_rows(Product, products), "next_cursor": next_cursor})
+        else:
+            products, next_cursor = await paginate(db.products, query, "created_at", limit, cursor)
+            body = ProductPage(items=products, next_cursor=next_cursor).model_dump_json().encode()
+        shows_stock = projection is None or "stock" in projection
+        entry = catalog_cache.put(cache_key, body, checkpoint,
+                                  [product["id"] for product in products] if shows_stock else ())
     
-    return products
+    return cached_json_response(entry, request)
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
+async def get_product(product_id: str, request: Request):
+    cache_key = ("product", product_id)
+    entry = catalog_cache.get(cache_key)
     
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if isinstance(product['created_at'], str):
-        product['created_at'] = datetime.fromisoformat(product['created_at'])
+    if entry is None:
+        checkpoint = catalog_cache.checkpoint()
+        product = await db.products.find_one({"id": product_id}, {"_id": 0})
+        
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        entry = catalog_cache.put(cache_key, Product(**product).model_dump_json().encode(), checkpoint, [product_id])
     
-    return product
+    return cached_json_response(entry, request)
 
 @api_router.patch("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, product_update: ProductUpdate):
@@ -261,7 +2670,10 @@ async def update_product(product_id: str, product_update: ProductUpdate):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    return await get_product(product_id)
+    catalog_cache.invalidate()
+    if "name" in update_data or "is_active" in update_data:
+        typeahead_index.invalidate()
+    return await db.products.find_one({"id": product_id}, {"_id": 0})
 
 
 # Event Routes
@@ -269,66 +2681,216 @@ async def update_product(product_id: str, product_update: ProductUpdate):
 async def create_event(event: EventCreate):
     event_obj = Event(**event.model_dump())
     doc = event_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['event_date'] = doc['event_date'].isoformat()
     
     await db.events.insert_one(doc)
-    return event_obj
+    typeahead_index.invalidate()
+    return created_response("events", event_obj, doc)
 
-@api_router.get("/events", response_model=List[Event])
-async def get_events(status: Optional[EventStatus] = None):
+@api_router.post("/events/bulk", response_model=EventBulkResult)
+async def create_events_bulk(events: List[dict]):
+    inserted, errors = await bulk_insert(db.events, events, EventCreate, Event)
+    
+    if inserted:
+        typeahead_index.invalidate()
+    return {"inserted": inserted, "errors": errors}
+
+@api_router.get("/events", response_model=EventPage)
+async def get_events(
+    status: Optional[EventStatus] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    include_archived: bool = False
+):
     query = {}
     if status:
         query["status"] = status
+    add_date_range(query, "event_date", date_from, date_to)
     
-    events = await db.events.find(query, {"_id": 0}).sort("event_date", -1).to_list(1000)
+    return await list_page("events", Event, public_db.events, query, "event_date", limit, cursor, fields, include_archived)
+
+@api_router.get("/events/calendar", response_model=List[Event])
+async def get_event_calendar(
+    date_from: datetime = Query(..., alias="from"),
+    date_to: datetime = Query(..., alias="to"),
+    status: Optional[EventStatus] = None,
+    include_archived: bool = False
+):
+    """Events with from <= event_date < to, earliest first, as one range scan on event_date."""
+    date_from, date_to = as_utc(date_from), as_utc(date_to)
+    if date_to <= date_from:
+        raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+    if date_to - date_from > timedelta(days=CALENDAR_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"Range is limited to {CALENDAR_MAX_DAYS} days")
     
-    for event in events:
-        if isinstance(event['created_at'], str):
-            event['created_at'] = datetime.fromisoformat(event['created_at'])
-        if isinstance(event['event_date'], str):
-            event['event_date'] = datetime.fromisoformat(event['event_date'])
+    query = add_date_range({}, "event_date", date_from, date_to)
+    if status:
+        query["status"] = status
     
-    return events
+    sources = [public_db.events]
+    if include_archived:
+        sources.append(public_db.events_archive)
+    found = await asyncio.gather(*(
+        source.find(query, {"_id": 0}).sort([("event_date", ASCENDING), ("id", ASCENDING)]).to_list(None)
+        for source in sources
+    ))
+    events = {event["id"]: event for batch in reversed(found) for event in batch}.values()
+    return sorted(events, key=lambda event: (event["event_date"], event["id"]))
+
+@api_router.get("/events/next", response_model=List[Event])
+async def get_next_events(limit: int = Query(3, ge=1, le=NEXT_EVENTS_MAX)):
+    """The soonest upcoming events, for the homepage."""
+    return await public_db.events.find(
+        {"status": EventStatus.UPCOMING, "event_date": {"$gte": datetime.now(timezone.utc)}},
+        {"_id": 0}
+    ).sort([("event_date", ASCENDING), ("id", ASCENDING)]).limit(limit).to_list(limit)
 
 @api_router.get("/events/{event_id}", response_model=Event)
-async def get_event(event_id: str):
-    event = await db.events.find_one({"id": event_id}, {"_id": 0})
+async def get_event(event_id: str, include_archived: bool = False):
+    event = await public_db.events.find_one({"id": event_id}, {"_id": 0})
+    if not event and include_archived:
+        event = await public_db.events_archive.find_one({"id": event_id}, {"_id": 0})
     
     if not event:
         raise HTTPException(status_code=404, detail="Event not found")
     
-    if isinstance(event['created_at'], str):
-        event['created_at'] = datetime.fromisoformat(event['created_at'])
-    if isinstance(event['event_date'], str):
-        event['event_date'] = datetime.fromisoformat(event['event_date'])
-    
     return event
 
+async def sign_up_for_event(event_id: str, registration: EventRegistrationCreate) -> EventRegistration:
+    if await claim_event_seat(event_id):
+        status = EventRegistrationStatus.CONFIRMED
+    else:
+        event = await db.events.find_one({"id": event_id}, {"_id": 0, "status": 1})
+        
+        if not event:
+            raise HTTPException(status_code=404, detail="Event not found")
+        if event.get("status") != EventStatus.UPCOMING:
+            raise HTTPException(status_code=409, detail="Registration is closed")
+        if not registration.waitlist:
+            raise HTTPException(status_code=409, detail="Event is full")
+        
+        status = EventRegistrationStatus.WAITLISTED
+    
+    registration_obj = EventRegistration(
+        event_id=event_id,
+        status=status,
+        **registration.model_dump(exclude={"waitlist"})
+    )
+    doc = registration_obj.model_dump()
+    
+    try:
+        await db.event_registrations.insert_one(doc)
+    except Exception:
+        if status == EventRegistrationStatus.CONFIRMED:
+            await release_event_seat(event_id)
+        raise
+    return registration_obj
+
+@api_router.post("/events/{event_id}/register", response_model=EventRegistration)
+async def register_for_event(
+    event_id: str,
+    registration: EventRegistrationCreate,
+    idempotency_key: Optional[str] = IdempotencyKey
+):
+    return await run_idempotent(
+        idempotency_key, f"events/{event_id}/register", registration,
+        lambda: sign_up_for_event(event_id, registration)
+    )
+
+@api_router.get("/events/{event_id}/registrations", response_model=EventRegistrationPage)
+async def get_event_registrations(
+    event_id: str,
+    status: Optional[EventRegistrationStatus] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    query = {"event_id": event_id}
+    if status:
+        query["status"] = status
+    
+    return await list_page("event_registrations", EventRegistration, db.event_registrations, query, "created_at", limit, cursor, fields)
+
+
+# Search Routes
+@api_router.get("/search", response_model=SearchResults)
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(10, ge=1, le=50)
+):
+    products, events = await asyncio.gather(
+        text_search(public_db.products, {"$text": {"$search": q}, "is_active": True}, limit),
+        text_search(public_db.events, {"$text": {"$search": q}}, limit),
+    )
+    
+    return {"products": products, "events": events}
+
+@api_router.get("/search/typeahead", response_model=List[TypeaheadSuggestion])
+async def typeahead(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(8, ge=1, le=20)
+):
+    return FastJSONResponse(typeahead_index.lookup(q, limit))
+
 
 # Lesson Registration Routes
-@api_router.post("/lessons/register", response_model=LessonRegistration)
-async def register_for_lesson(registration: LessonRegistrationCreate):
+async def save_lesson_registration(registration: LessonRegistrationCreate) -> LessonRegistration:
     registration_obj = LessonRegistration(**registration.model_dump())
     doc = registration_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.lesson_registrations.insert_one(doc)
+    buffer = write_behind_buffers.get("lessons")
+    if buffer:
+        await buffer.submit(doc)
+    else:
+        await db.lesson_registrations.insert_one(doc)
     return registration_obj
 
-@api_router.get("/lessons/registrations", response_model=List[LessonRegistration])
-async def get_lesson_registrations(status: Optional[LessonStatus] = None):
+@api_router.post("/lessons/register", response_model=LessonRegistration)
+async def register_for_lesson(
+    registration: LessonRegistrationCreate,
+    idempotency_key: Optional[str] = IdempotencyKey
+):
+    return await run_idempotent(
+        idempotency_key, "lessons/register", registration,
+        lambda: save_lesson_registration(registration)
+    )
+
+@api_router.get("/lessons/registrations", response_model=LessonRegistrationPage)
+async def get_lesson_registrations(
+    status: Optional[LessonStatus] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
     query = {}
     if status:
         query["status"] = status
+    add_date_range(query, "created_at", created_from, created_to)
     
-    registrations = await db.lesson_registrations.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    
-    for reg in registrations:
-        if isinstance(reg['created_at'], str):
-            reg['created_at'] = datetime.fromisoformat(reg['created_at'])
+    return await list_page("lesson_registrations", LessonRegistration, db.lesson_registrations, query, "created_at", limit, cursor, fields)
+
+@api_router.get("/lessons/registrations/export")
+async def export_lesson_registrations(
+    format: ExportFormat = ExportFormat.NDJSON,
+    status: Optional[LessonStatus] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None
+):
+    query = {}
+    if status:
+        query["status"] = status
+    add_date_range(query, "created_at", created_from, created_to)
     
-    return registrations
+    return export_response("lesson_registrations", query, format)
+
+@api_router.patch("/lessons/registrations/status", response_model=StatusBulkResult)
+async def bulk_update_registration_status(update: LessonStatusBulkUpdate):
+    query = bulk_status_query(update.ids, update.filter)
+    return await bulk_transition(db.lesson_registrations, query, update.status, LESSON_TRANSITIONS, update.ids)
 
 @api_router.patch("/lessons/registrations/{registration_id}/status")
 async def update_registration_status(registration_id: str, status: LessonStatus):
@@ -344,140 +2906,357 @@ async def update_registration_status(registration_id: str, status: LessonStatus)
 
 
 # Order Routes
-@api_router.post("/orders", response_model=Order)
-async def create_order(order: OrderCreate):
-    order_obj = Order(**order.model_dump())
+async def place_order(order: OrderCreate) -> Order:
+    lines = await price_order_lines(merge_order_lines(order.items))
+    await reserve_stock(lines)
+    
+    order_obj = Order(
+        customer_name=order.customer_name,
+        customer_email=order.customer_email,
+        customer_phone=order.customer_phone,
+        items=lines,
+        total_amount=round(sum(line.price * line.quantity for line in lines), 2),
+        stock_reserved=True
+    )
     doc = order_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.orders.insert_one(doc)
+    try:
+        await db.orders.insert_one(doc)
+    except Exception:
+        await release_stock(lines)
+        raise
     return order_obj
 
-@api_router.get("/orders", response_model=List[Order])
-async def get_orders(status: Optional[OrderStatus] = None):
+@api_router.post("/orders", response_model=Order)
+async def create_order(order: OrderCreate, idempotency_key: Optional[str] = IdempotencyKey):
+    return await run_idempotent(idempotency_key, "orders", order, lambda: place_order(order))
+
+@api_router.get("/orders", response_model=OrderPage)
+async def get_orders(
+    status: Optional[OrderStatus] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    include_archived: bool = False
+):
     query = {}
     if status:
         query["status"] = status
+    add_date_range(query, "created_at", created_from, created_to)
     
-    orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    
-    for order in orders:
-        if isinstance(order['created_at'], str):
-            order['created_at'] = datetime.fromisoformat(order['created_at'])
+    return await list_page("orders", Order, db.orders, query, "created_at", limit, cursor, fields, include_archived)
+
+@api_router.get("/orders/export")
+async def export_orders(
+    format: ExportFormat = ExportFormat.NDJSON,
+    status: Optional[OrderStatus] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    include_archived: bool = False
+):
+    query = {}
+    if status:
+        query["status"] = status
+    add_date_range(query, "created_at", created_from, created_to)
     
-    return orders
+    return export_response("orders", query, format, include_archived)
 
 @api_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str):
+async def get_order(order_id: str, include_archived: bool = False):
     order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+    if not order and include_archived:
+        order = await db.orders_archive.find_one({"id": order_id}, {"_id": 0})
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    if isinstance(order['created_at'], str):
-        order['created_at'] = datetime.fromisoformat(order['created_at'])
-    
     return order
 
+@api_router.patch("/orders/status", response_model=StatusBulkResult)
+async def bulk_update_order_status(update: OrderStatusBulkUpdate):
+    query = bulk_status_query(update.ids, update.filter)
+    return await bulk_transition(db.orders, query, update.status, ORDER_TRANSITIONS, update.ids, orders=True)
+
 @api_router.patch("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: OrderStatus, mpesa_reference: Optional[str] = None):
     update_data = {"status": status}
     if mpesa_reference:
         update_data["mpesa_reference"] = mpesa_reference
     
-    result = await db.orders.update_one(
-        {"id": order_id},
-        {"$set": update_data}
+    query = {"id": order_id}
+    if status != OrderStatus.CANCELLED:
+        # Cancelling gave the stock back, so a cancelled order can't be reopened
+        query["status"] = {"$ne": OrderStatus.CANCELLED}
+    before = await db.orders.find_one_and_update(
+        query,
+        {"$set": update_data},
+        projection={"_id": 0, "status": 1, "items": 1, "created_at": 1, "stock_reserved": 1}
     )
     
-    if result.matched_count == 0:
+    if before is None:
+        if await db.orders.count_documents({"id": order_id}, limit=1):
+            raise HTTPException(status_code=409, detail="Order is cancelled")
         raise HTTPException(status_code=404, detail="Order not found")
     
+    await apply_order_transitions([{**before, "previous_status": before["status"]}], status)
+    
     return {"message": "Order status updated", "status": status}
 
 
 # Contact Routes
-@api_router.post("/contact", response_model=ContactSubmission)
-async def submit_contact_form(contact: ContactSubmissionCreate):
+async def save_contact_submission(contact: ContactSubmissionCreate) -> ContactSubmission:
     contact_obj = ContactSubmission(**contact.model_dump())
     doc = contact_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.contact_submissions.insert_one(doc)
+    buffer = write_behind_buffers.get("contact")
+    if buffer:
+        await buffer.submit(doc)
+    else:
+        await db.contact_submissions.insert_one(doc)
     return contact_obj
 
-@api_router.get("/contact/submissions", response_model=List[ContactSubmission])
-async def get_contact_submissions():
-    submissions = await db.contact_submissions.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+@api_router.post("/contact", response_model=ContactSubmission)
+async def submit_contact_form(contact: ContactSubmissionCreate, idempotency_key: Optional[str] = IdempotencyKey):
+    return await run_idempotent(idempotency_key, "contact", contact, lambda: save_contact_submission(contact))
+
+@api_router.get("/contact/submissions", response_model=ContactSubmissionPage)
+async def get_contact_submissions(
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    include_archived: bool = False
+):
+    query = add_date_range({}, "created_at", created_from, created_to)
     
-    for sub in submissions:
-        if isinstance(sub['created_at'], str):
-            sub['created_at'] = datetime.fromisoformat(sub['created_at'])
+    return await list_page("contact_submissions", ContactSubmission, db.contact_submissions, query, "created_at", limit, cursor, fields, include_archived)
+
+
+@api_router.get("/contact/submissions/export")
+async def export_contact_submissions(
+    format: ExportFormat = ExportFormat.NDJSON,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    include_archived: bool = False
+):
+    query = add_date_range({}, "created_at", created_from, created_to)
     
-    return submissions
+    return export_response("contact_submissions", query, format, include_archived)
 
 
 # Newsletter Routes
 @api_router.post("/newsletter/subscribe", response_model=NewsletterSubscription)
 async def subscribe_newsletter(subscription: NewsletterSubscriptionCreate):
-    # Check if email already exists
-    existing = await db.newsletter_subscriptions.find_one({"email": subscription.email})
-    
-    if existing:
-        # Reactivate if previously unsubscribed
-        await db.newsletter_subscriptions.update_one(
-            {"email": subscription.email},
-            {"$set": {"is_active": True}}
-        )
-        existing['is_active'] = True
-        if isinstance(existing['subscribed_at'], str):
-            existing['subscribed_at'] = datetime.fromisoformat(existing['subscribed_at'])
-        return NewsletterSubscription(**existing)
+    email = normalize_email(subscription.email)
+    
+    buffer = write_behind_buffers.get("newsletter")
+    if buffer:
+        # Acknowledged before the upsert runs: a new subscriber is stored with the id and date
+        # answered here, an existing one is answered with these rather than the stored ones
+        subscription_obj = NewsletterSubscription(email=email)
+        await buffer.submit(subscription_obj.model_dump())
+        return subscription_obj
+    
+    # One atomic upsert; the unique email index makes racing submits converge on one document
+    return await db.newsletter_subscriptions.find_one_and_update(
+        {"email": email},
+        newsletter_upsert(email),
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+@api_router.post("/newsletter/import", response_model=NewsletterImportResult)
+async def import_newsletter_subscribers(request: Request):
+    """
+    Import a CSV of subscribers sent as the raw request body.
+    Uses the "email" column when there is a header row, otherwise the first column.
+    """
+    totals = {"new": 0, "reactivated": 0, "already_active": 0, "invalid": 0}
+    email_column = None
+    batch = set()
+    
+    async for row in iter_csv_rows(request):
+        if not row:
+            continue
+        if email_column is None:
+            header = [cell.strip().lower() for cell in row]
+            email_column = header.index("email") if "email" in header else 0
+            if "email" in header:
+                continue
+        
+        try:
+            email = NewsletterSubscriptionCreate(email=row[email_column].strip()).email
+        except (ValidationError, IndexError):
+            totals["invalid"] += 1
+            continue
+        
+        batch.add(normalize_email(email))
+        if len(batch) >= NEWSLETTER_IMPORT_BATCH_SIZE:
+            await upsert_subscribers(batch, totals)
+            batch = set()
+    
+    await upsert_subscribers(batch, totals)
+    return totals
+
+
+# Admin Routes
+@api_router.get("/admin/query-plans")
+async def get_query_plans():
+    report = await explain_query_shapes(db)
+    return {
+        "ok": not any(entry["collscan"] for entry in report),
+        "queries": report
+    }
+
+
+@api_router.get("/admin/analytics/sales", response_model=SalesReport)
+async def get_sales_analytics(
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    category: Optional[ProductCategory] = None
+):
+    query = add_date_range({}, "day", date_from, date_to)
+    if category:
+        query["category"] = category
     
-    subscription_obj = NewsletterSubscription(**subscription.model_dump())
-    doc = subscription_obj.model_dump()
-    doc['subscribed_at'] = doc['subscribed_at'].isoformat()
+    rows = await db.sales_daily.find(query, {"_id": 0}).sort(
+        [("day", ASCENDING), ("category", ASCENDING)]
+    ).to_list(None)
     
-    await db.newsletter_subscriptions.insert_one(doc)
-    return subscription_obj
+    return {
+        "rows": rows,
+        "revenue": round(sum(row["revenue"] for row in rows), 2),
+        "units": sum(row["units"] for row in rows),
+    }
 
 
-# M-Pesa Integration Placeholder (Structure ready for Daraja API)
+# M-Pesa Routes
 @api_router.post("/mpesa/stk-push")
 async def initiate_mpesa_payment(
     phone_number: str,
-    amount: float,
-    order_id: str
+    order_id: str,
+    amount: Optional[float] = None
 ):
     """
-    This is a placeholder for M-Pesa STK Push integration.
-    You'll need to add Daraja API credentials in .env:
-    - MPESA_CONSUMER_KEY
-    - MPESA_CONSUMER_SECRET
-    - MPESA_SHORTCODE
-    - MPESA_PASSKEY
+    Send an STK push prompt for a pending order.
+    The amount charged is always the order's total; `amount` is accepted for older clients
+    but ignored. Needs MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET, MPESA_SHORTCODE,
+    MPESA_PASSKEY, MPESA_CALLBACK_URL and MPESA_CALLBACK_TOKEN in .env.
     """
-    # TODO: Implement actual M-Pesa Daraja API integration
+    order = await db.orders.find_one({"id": order_id}, {"_id": 0, "status": 1, "total_amount": 1})
+    
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    if order["status"] != OrderStatus.PENDING:
+        raise HTTPException(status_code=409, detail="Order is not awaiting payment")
+    
+    msisdn = normalize_msisdn(phone_number)
+    # Rounded up, so a callback for the full charge always covers total_amount
+    charge = max(1, math.ceil(order["total_amount"]))
+    try:
+        result = await daraja.stk_push(msisdn, charge, order_id, "Kashoe order")
+    except DarajaNotConfigured:
+        raise HTTPException(status_code=503, detail="M-Pesa is not configured")
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        logger.error(f"STK push for order {order_id} failed: {e}")
+        raise HTTPException(status_code=502, detail="M-Pesa request failed")
+    
+    if str(result.get("ResponseCode")) != "0":
+        raise HTTPException(status_code=502, detail=result.get("ResponseDescription", "M-Pesa rejected the request"))
+    
+    await db.orders.update_one(
+        {"id": order_id},
+        {
+            "$set": {"mpesa_checkout_request_id": result["CheckoutRequestID"]},
+            # A retried push mustn't orphan an earlier prompt the customer may still pay
+            "$addToSet": {"mpesa_checkout_request_ids": result["CheckoutRequestID"]},
+        }
+    )
     return {
-        "message": "M-Pesa integration placeholder",
+        "message": result.get("CustomerMessage", "Payment prompt sent"),
         "order_id": order_id,
-        "amount": amount,
-        "phone_number": phone_number,
+        "amount": charge,
+        "phone_number": msisdn,
         "status": "pending"
     }
 
-@api_router.post("/mpesa/callback")
-async def mpesa_callback(callback_data: dict):
+@api_router.post("/mpesa/callback/{token}")
+async def mpesa_callback(token: str, callback_data: dict):
     """
-    This endpoint will receive M-Pesa payment callbacks
+    Receive an M-Pesa STK callback. It is stored in the inbox and acked straight away;
+    the order is updated by the background callback queue. Only Safaricom knows the
+    token, because it is only ever sent to them as part of CallBackURL.
     """
-    # TODO: Process M-Pesa callback and update order status
-    return {"message": "Callback received"}
+    if not daraja.valid_callback_token(token):
+        raise HTTPException(status_code=403, detail="Invalid callback token")
+    
+    callback = parse_stk_callback(callback_data)
+    checkout_request_id = callback.pop("checkout_request_id")
+    
+    if not checkout_request_id:
+        raise HTTPException(status_code=400, detail="Missing CheckoutRequestID")
+    
+    # Keyed by CheckoutRequestID, so Safaricom's redeliveries collapse into one entry
+    result = await db.mpesa_callbacks.update_one(
+        {"_id": checkout_request_id},
+        {"$setOnInsert": {
+            **callback,
+            "payload": callback_data,
+            "received_at": datetime.now(timezone.utc),
+            "processed_at": None,
+        }},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        mpesa_callback_queue.submit(checkout_request_id)
+    
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(metrics_registry()), media_type=CONTENT_TYPE_LATEST)
 
 
 # Include the router in the main app
 app.include_router(api_router)
 
+if profiling_enabled():
+    if Profiler is None:
+        raise RuntimeError("PROFILE_* settings need pyinstrument (pip install pyinstrument)")
+    app.add_middleware(
+        ProfilingMiddleware,
+        directory=Path(os.environ.get('PROFILE_DIR', '/tmp/kashoe-profiles')),
+        sample_rate=PROFILE_SAMPLE_RATE,
+        slow_ms=PROFILE_SLOW_MS,
+        token=PROFILE_TOKEN,
+        max_files=int(os.environ.get('PROFILE_MAX_FILES', '200')),
+        interval=float(os.environ.get('PROFILE_INTERVAL_MS', '1')) / 1000,
+    )
+app.add_middleware(
+    RateLimitMiddleware,
+    limits=parse_rate_limits(os.environ.get('RATE_LIMITS', '')),
+    buckets=TokenBuckets(max_entries=int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))),
+    shedder=LoadShedder(
+        max_concurrent=int(os.environ.get('MAX_CONCURRENT_REQUESTS', '0')),
+        low_priority_share=float(os.environ.get('LOW_PRIORITY_SHARE', '0.5')),
+        mongo_latency_limit=float(os.environ.get('SHED_MONGO_LATENCY_MS', '250')) / 1000,
+    ),
+    trust_forwarded_for=os.environ.get('TRUST_FORWARDED_FOR', 'false').lower() == 'true',
+)
+app.add_middleware(MetricsMiddleware)
+
+# Responses smaller than this aren't worth the CPU; brotli falls back to gzip for clients without it
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get('COMPRESSION_MINIMUM_SIZE', '1024'))
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -492,7 +3271,3 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
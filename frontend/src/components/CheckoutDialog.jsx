@@ -1,4 +1,4 @@
-import { useState } from 'react';
+import { useRef, useState } from 'react';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogDescription } from '@/components/ui/dialog';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
@@ -13,6 +13,8 @@ const API = `${BACKEND_URL}/api`;
 const CheckoutDialog = ({ open, onOpenChange }) => {
   const { cart, getCartTotal, clearCart } = useCart();
   const [loading, setLoading] = useState(false);
+  // Reused across retries of the same checkout so the server creates the order only once
+  const idempotencyKey = useRef(crypto.randomUUID());
   const [formData, setFormData] = useState({
     customer_name: '',
     customer_email: '',
@@ -43,7 +45,10 @@ const CheckoutDialog = ({ open, onOpenChange }) => {
         total_amount: getCartTotal(),
       };
 
-      const response = await axios.post(`${API}/orders`, orderData);
+      const response = await axios.post(`${API}/orders`, orderData, {
+        headers: { 'Idempotency-Key': idempotencyKey.current },
+      });
+      idempotencyKey.current = crypto.randomUUID();
       
       // In production, this would initiate M-Pesa STK push
       // For now, we'll just show success message
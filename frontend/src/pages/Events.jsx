@@ -10,17 +10,37 @@ const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
 const Events = () => {
-  const [events, setEvents] = useState([]);
+  const [upcomingEvents, setUpcomingEvents] = useState([]);
+  const [pastEvents, setPastEvents] = useState([]);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
     fetchEvents();
   }, []);
 
+  // Every upcoming event, following next_cursor through all pages
+  const fetchUpcomingEvents = async () => {
+    const upcoming = [];
+    let cursor = null;
+    do {
+      const response = await axios.get(`${API}/events`, {
+        params: { status: 'upcoming', ...(cursor && { cursor }) },
+      });
+      upcoming.push(...response.data.items);
+      cursor = response.data.next_cursor;
+    } while (cursor);
+    // Pages come newest first; list the soonest event first
+    return upcoming.reverse();
+  };
+
   const fetchEvents = async () => {
     try {
-      const response = await axios.get(`${API}/events`);
-      setEvents(response.data);
+      const [upcoming, past] = await Promise.all([
+        fetchUpcomingEvents(),
+        axios.get(`${API}/events`, { params: { status: 'completed' } }),
+      ]);
+      setUpcomingEvents(upcoming);
+      setPastEvents(past.data.items);
     } catch (error) {
       console.error('Error fetching events:', error);
     } finally {
@@ -38,9 +58,6 @@ const Events = () => {
     return colors[status] || 'bg-gray-500';
   };
 
-  const upcomingEvents = events.filter(e => e.status === 'upcoming');
-  const pastEvents = events.filter(e => e.status === 'completed');
-
   return (
     <div className="min-h-screen">
       {/* Hero Section */}
@@ -23,8 +23,17 @@ const Shop = () => {
 
   const fetchProducts = async () => {
     try {
-      const response = await axios.get(`${API}/products`);
-      setProducts(response.data);
+      // Follow next_cursor so the whole catalog is listed, not just the first page
+      const all = [];
+      let cursor = null;
+      do {
+        const response = await axios.get(`${API}/products`, {
+          params: { limit: 200, ...(cursor && { cursor }) },
+        });
+        all.push(...response.data.items);
+        cursor = response.data.next_cursor;
+      } while (cursor);
+      setProducts(all);
     } catch (error) {
       console.error('Error fetching products:', error);
     } finally {
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Move finished events, orders and old contact submissions to their archive collections
+
+Applies the same ARCHIVE_* policies as the backend's background archiver (enabled
+with ARCHIVE_INTERVAL), once, in batches of ARCHIVE_BATCH_SIZE. Safe to interrupt
+and rerun: a batch cut off halfway is finished by the next run.
+"""
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import db, archive_cold_documents, ensure_indexes  # noqa: E402
+
+
+async def archive():
+    await ensure_indexes(db)
+    started = time.perf_counter()
+    moved = await archive_cold_documents(db)
+    for collection_name, count in moved.items():
+        print(f"  {collection_name:22} {count} archived")
+    print(f"✓ Archive pass finished in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__.strip().splitlines()[0]).parse_args()
+    asyncio.run(archive())
+
+
+if __name__ == "__main__":
+    main()
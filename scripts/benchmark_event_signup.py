@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Hammer event sign-up with concurrent requests and check nobody is overbooked
+
+Creates a throwaway event with a small capacity, fires many concurrent
+registrations at it, then checks that the confirmed registrations, the event's
+current_participants counter and max_participants all agree.
+"""
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BACKEND_URL = "http://localhost:8001/api"
+
+_local = threading.local()
+
+
+def session():
+    # One pooled session per worker thread; requests.Session is not thread-safe
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def create_event(capacity):
+    response = requests.post(f"{BACKEND_URL}/events", json={
+        "title": f"Sign-up benchmark {datetime.now(timezone.utc):%Y-%m-%d %H:%M:%S}",
+        "description": "Created by scripts/benchmark_event_signup.py",
+        "event_date": (datetime.now(timezone.utc) + timedelta(days=30)).isoformat(),
+        "location": "Benchmark",
+        "max_participants": capacity,
+    })
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def register(event_id, n, waitlist):
+    started = time.perf_counter()
+    response = session().post(f"{BACKEND_URL}/events/{event_id}/register", json={
+        "participant_name": f"Player {n}",
+        "email": f"player{n}@example.com",
+        "phone": "0700000000",
+        "waitlist": waitlist,
+    })
+    elapsed = time.perf_counter() - started
+    if response.status_code == 200:
+        return response.json()["status"], elapsed
+    if response.status_code == 409:
+        return "full", elapsed
+    return f"error {response.status_code}", elapsed
+
+
+def count_registrations(event_id, status):
+    count = 0
+    cursor = None
+    while True:
+        params = {"status": status, "limit": 200}
+        if cursor:
+            params["cursor"] = cursor
+        page = requests.get(f"{BACKEND_URL}/events/{event_id}/registrations", params=params).json()
+        count += len(page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--capacity", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--waitlist", action="store_true", help="join the waitlist when full")
+    args = parser.parse_args()
+
+    event_id = create_event(args.capacity)
+    print(f"Event {event_id}: capacity {args.capacity}, "
+          f"{args.requests} sign-ups over {args.concurrency} threads")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda n: register(event_id, n, args.waitlist), range(args.requests)))
+    wall = time.perf_counter() - started
+
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    latencies = sorted(elapsed for _, elapsed in results)
+
+    print(f"\n{args.requests / wall:.0f} req/s, "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+    for outcome, count in sorted(outcomes.items()):
+        print(f"  {outcome:12} {count}")
+
+    event = requests.get(f"{BACKEND_URL}/events/{event_id}").json()
+    confirmed = count_registrations(event_id, "confirmed")
+    print(f"\ncurrent_participants={event['current_participants']} "
+          f"confirmed registrations={confirmed} max_participants={event['max_participants']}")
+
+    ok = (
+        event["current_participants"] == confirmed == outcomes.get("confirmed", 0)
+        and confirmed <= args.capacity
+        and confirmed == min(args.capacity, args.requests)
+    )
+    if not ok:
+        print("✗ Sign-up counts disagree")
+        sys.exit(1)
+    print("✓ No overbooking")
+
+
+if __name__ == "__main__":
+    main()
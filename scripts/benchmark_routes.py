@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Load-test every API route in-process and compare latency against a stored baseline
+
+The app from backend/server.py is driven through an in-process ASGI transport, so
+no server has to be running. It talks to a real mongod (MONGO_URL, database
+kashoe_benchmark by default) or, with --in-memory, to mongomock-motor. The
+database is seeded once with realistic volumes and reused on later runs.
+
+    python3 scripts/benchmark_routes.py                      # compare with the baseline
+    python3 scripts/benchmark_routes.py --update-baseline    # record a new baseline
+    python3 scripts/benchmark_routes.py --only "GET /api/orders"
+
+Exits non-zero when any route's p95 latency or throughput is worse than the
+baseline by more than --threshold. Only compare runs made on the same machine.
+With --require-baseline (the default when CI is set), a missing baseline file or a
+route missing from it fails the run instead of passing with a warning.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCHMARK_DB_NAME", "kashoe_benchmark")
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+
+BASELINE_PATH = Path(__file__).resolve().parent / "benchmark_baseline.json"
+
+VOLUMES = {
+    "products": 1_000,
+    "events": 500,
+    "orders": 100_000,
+    "lesson_registrations": 10_000,
+    "contact_submissions": 10_000,
+    "newsletter_subscriptions": 10_000,
+}
+SEED_BATCH_SIZE = 5_000
+
+# Routes deliberately left out, with the reason
+SKIPPED_ROUTES = {
+    "POST /api/mpesa/stk-push": "calls Daraja; covered by scripts/check_mpesa_cycle.py",
+}
+
+
+# ============= SEEDING =============
+def some_time_ago(days=365):
+    """A created_at somewhere in the last year"""
+    return datetime.now(timezone.utc) - timedelta(seconds=random.random() * days * 86400)
+
+
+def fake_product(n):
+    return server.Product(
+        name=f"Benchmark product {n}",
+        description="Tournament-grade chess equipment for benchmarking",
+        category=random.choice(list(server.ProductCategory)),
+        price=float(random.randint(5, 120) * 100),
+        stock=10_000_000,
+        created_at=some_time_ago(),
+    ).model_dump()
+
+
+def fake_event(n):
+    return server.Event(
+        title=f"Benchmark event {n}",
+        description="Fun tournament for kids",
+        event_date=datetime.now(timezone.utc) + timedelta(days=random.randint(-300, 300)),
+        location="Kashoe Chess Club, Nairobi",
+        status=random.choice(list(server.EventStatus)),
+        created_at=some_time_ago(),
+    ).model_dump()
+
+
+def fake_order(n, products):
+    lines = random.sample(products, k=random.randint(1, 3))
+    items = [{"product_id": p["id"], "product_name": p["name"], "quantity": random.randint(1, 3), "price": p["price"]}
+             for p in lines]
+    return server.Order(
+        customer_name=f"Customer {n}",
+        customer_email=f"customer{n}@example.com",
+        customer_phone="0712345678",
+        items=items,
+        total_amount=sum(item["price"] * item["quantity"] for item in items),
+        status=random.choice(list(server.OrderStatus)),
+        created_at=some_time_ago(),
+    ).model_dump()
+
+
+def fake_lesson_registration(n):
+    return server.LessonRegistration(
+        student_name=f"Student {n}",
+        parent_name=f"Parent {n}",
+        email=f"parent{n}@example.com",
+        phone="0712345678",
+        age=random.randint(5, 16),
+        lesson_type=random.choice(["Beginner", "Intermediate", "Advanced"]),
+        preferred_schedule="Saturday morning",
+        status=random.choice(list(server.LessonStatus)),
+        created_at=some_time_ago(),
+    ).model_dump()
+
+
+def fake_contact_submission(n):
+    return server.ContactSubmission(
+        name=f"Visitor {n}",
+        email=f"visitor{n}@example.com",
+        subject="Lessons enquiry",
+        message="Do you have weekend classes for beginners?",
+        created_at=some_time_ago(),
+    ).model_dump()
+
+
+def fake_subscription(n):
+    return server.NewsletterSubscription(email=f"reader{n}@example.com").model_dump()
+
+
+async def seed_collection(db, name, target, make):
+    existing = await db[name].count_documents({})
+    if existing >= target:
+        return
+    for start in range(existing, target, SEED_BATCH_SIZE):
+        docs = [make(n) for n in range(start, min(start + SEED_BATCH_SIZE, target))]
+        await db[name].insert_many(docs, ordered=False)
+        print(f"  {name}: {start + len(docs)}/{target}", end="\r")
+    print(f"  {name}: {target} seeded" + " " * 20)
+
+
+async def seed(db, reseed):
+    if reseed:
+        for name in list(VOLUMES) + ["event_registrations", "idempotency_keys", "mpesa_callbacks", "sales_daily"]:
+            await db[name].drop()
+    await server.ensure_indexes(db)
+
+    await seed_collection(db, "products", VOLUMES["products"], fake_product)
+    products = await db.products.find({}, {"_id": 0, "id": 1, "name": 1, "price": 1}).to_list(None)
+    await seed_collection(db, "events", VOLUMES["events"], fake_event)
+    await seed_collection(db, "orders", VOLUMES["orders"], lambda n: fake_order(n, products))
+    await seed_collection(db, "lesson_registrations", VOLUMES["lesson_registrations"], fake_lesson_registration)
+    await seed_collection(db, "contact_submissions", VOLUMES["contact_submissions"], fake_contact_submission)
+    await seed_collection(db, "newsletter_subscriptions", VOLUMES["newsletter_subscriptions"], fake_subscription)
+    if reseed or not await db.sales_daily.count_documents({}):
+        await server.rebuild_sales_rollups(db)
+
+
+async def load_fixtures(db):
+    """Ids the scenarios pick from"""
+    async def ids(name, query=None, limit=1000):
+        return [doc["id"] for doc in await db[name].find(query or {}, {"_id": 0, "id": 1}).limit(limit).to_list(limit)]
+
+    await db.products.update_many({}, {"$set": {"is_active": True, "stock": 10_000_000}})
+    event_id = str(uuid.uuid4())
+    await db.events.insert_one(server.Event(
+        id=event_id, title="Benchmark open event", description="No capacity limit",
+        event_date=datetime.now(timezone.utc) + timedelta(days=30), location="Nairobi",
+    ).model_dump())
+    return {
+        "products": await ids("products"),
+        "events": await ids("events"),
+        "open_event": event_id,
+        "orders": await ids("orders"),
+        "lesson_registrations": await ids("lesson_registrations"),
+    }
+
+
+# ============= SCENARIOS =============
+def week_ago():
+    return (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+
+
+def order_body(fx, n):
+    return {
+        "customer_name": f"Load {n}", "customer_email": f"load{n}@example.com", "customer_phone": "0712345678",
+        "items": [{"product_id": random.choice(fx["products"]), "quantity": 1}],
+    }
+
+
+def product_body(fx, n):
+    return {"name": f"Load product {n}", "description": "Created by the benchmark",
+            "category": "merchandise", "price": 500.0, "stock": 10}
+
+
+def event_body(fx, n):
+    return {"title": f"Load event {n}", "description": "Created by the benchmark",
+            "event_date": (datetime.now(timezone.utc) + timedelta(days=60)).isoformat(), "location": "Nairobi"}
+
+
+def stk_callback(fx, n):
+    return {"Body": {"stkCallback": {
+        "MerchantRequestID": f"bench-{n}", "CheckoutRequestID": f"ws_CO_bench_{uuid.uuid4().hex}",
+        "ResultCode": 1032, "ResultDesc": "Request cancelled by user",
+    }}}
+
+
+def subscriber_csv(fx, n):
+    rows = "\n".join(f"import{n}-{i}@example.com" for i in range(100))
+    return f"email\n{rows}\n"
+
+
+# (route, method, path, request kwargs builder); builders get the fixtures and a request number
+SCENARIOS = [
+    ("GET /api/", "GET", lambda fx, n: "/api/", None),
+    ("POST /api/products", "POST", lambda fx, n: "/api/products", lambda fx, n: {"json": product_body(fx, n)}),
+    ("POST /api/products/bulk", "POST", lambda fx, n: "/api/products/bulk",
+     lambda fx, n: {"json": [product_body(fx, f"{n}-{i}") for i in range(50)]}),
+    ("GET /api/products", "GET", lambda fx, n: "/api/products", None),
+    ("GET /api/products/{product_id}", "GET", lambda fx, n: f"/api/products/{random.choice(fx['products'])}", None),
+    ("PATCH /api/products/{product_id}", "PATCH", lambda fx, n: f"/api/products/{random.choice(fx['products'])}",
+     lambda fx, n: {"json": {"price": float(random.randint(5, 120) * 100)}}),
+    ("POST /api/events", "POST", lambda fx, n: "/api/events", lambda fx, n: {"json": event_body(fx, n)}),
+    ("POST /api/events/bulk", "POST", lambda fx, n: "/api/events/bulk",
+     lambda fx, n: {"json": [event_body(fx, f"{n}-{i}") for i in range(50)]}),
+    ("GET /api/events", "GET", lambda fx, n: "/api/events", None),
+    ("GET /api/events/{event_id}", "GET", lambda fx, n: f"/api/events/{random.choice(fx['events'])}", None),
+    ("POST /api/events/{event_id}/register", "POST", lambda fx, n: f"/api/events/{fx['open_event']}/register",
+     lambda fx, n: {"json": {"participant_name": f"Player {n}", "email": f"player{n}@example.com", "phone": "0712345678"}}),
+    ("GET /api/events/{event_id}/registrations", "GET",
+     lambda fx, n: f"/api/events/{fx['open_event']}/registrations", None),
+    ("GET /api/search", "GET", lambda fx, n: "/api/search",
+     lambda fx, n: {"params": {"q": random.choice(["chess", "tournament", "clock", "board"])}}),
+    ("GET /api/search/typeahead", "GET", lambda fx, n: "/api/search/typeahead",
+     lambda fx, n: {"params": {"q": random.choice(["ben", "benchmark p", "chess", "load"])}}),
+    ("POST /api/lessons/register", "POST", lambda fx, n: "/api/lessons/register", lambda fx, n: {"json": {
+        "student_name": f"Student {n}", "parent_name": "Parent", "email": f"student{n}@example.com",
+        "phone": "0712345678", "age": 9, "lesson_type": "Beginner", "preferred_schedule": "Saturday"}}),
+    ("GET /api/lessons/registrations", "GET", lambda fx, n: "/api/lessons/registrations", None),
+    ("GET /api/lessons/registrations/export", "GET", lambda fx, n: "/api/lessons/registrations/export",
+     lambda fx, n: {"params": {"created_from": week_ago()}}),
+    ("PATCH /api/lessons/registrations/{registration_id}/status", "PATCH",
+     lambda fx, n: f"/api/lessons/registrations/{random.choice(fx['lesson_registrations'])}/status",
+     lambda fx, n: {"params": {"status": "approved"}}),
+    ("POST /api/orders", "POST", lambda fx, n: "/api/orders", lambda fx, n: {"json": order_body(fx, n)}),
+    ("GET /api/orders", "GET", lambda fx, n: "/api/orders", None),
+    ("GET /api/orders?status=", "GET", lambda fx, n: "/api/orders", lambda fx, n: {"params": {"status": "paid"}}),
+    ("GET /api/orders/export", "GET", lambda fx, n: "/api/orders/export",
+     lambda fx, n: {"params": {"created_from": week_ago()}}),
+    ("GET /api/orders/{order_id}", "GET", lambda fx, n: f"/api/orders/{random.choice(fx['orders'])}", None),
+    ("PATCH /api/orders/{order_id}/status", "PATCH", lambda fx, n: f"/api/orders/{random.choice(fx['orders'])}/status",
+     lambda fx, n: {"params": {"status": "processing"}}),
+    ("POST /api/contact", "POST", lambda fx, n: "/api/contact", lambda fx, n: {"json": {
+        "name": f"Visitor {n}", "email": f"visitor{n}@example.com", "subject": "Hello", "message": "Benchmark"}}),
+    ("GET /api/contact/submissions", "GET", lambda fx, n: "/api/contact/submissions", None),
+    ("GET /api/contact/submissions/export", "GET", lambda fx, n: "/api/contact/submissions/export",
+     lambda fx, n: {"params": {"created_from": week_ago()}}),
+    ("POST /api/newsletter/subscribe", "POST", lambda fx, n: "/api/newsletter/subscribe",
+     lambda fx, n: {"json": {"email": f"reader{random.randint(0, 20_000)}@example.com"}}),
+    ("POST /api/newsletter/import", "POST", lambda fx, n: "/api/newsletter/import",
+     lambda fx, n: {"content": subscriber_csv(fx, n), "headers": {"Content-Type": "text/csv"}}),
+    ("GET /api/admin/query-plans", "GET", lambda fx, n: "/api/admin/query-plans", None),
+    ("GET /api/admin/analytics/sales", "GET", lambda fx, n: "/api/admin/analytics/sales", None),
+    ("POST /api/mpesa/callback/{token}", "POST", lambda fx, n: f"/api/mpesa/callback/{server.daraja.callback_token or 'unset'}",
+     lambda fx, n: {"json": stk_callback(fx, n)}),
+]
+
+
+def uncovered_routes():
+    covered = {route.split("?")[0] for route, *_ in SCENARIOS} | set(SKIPPED_ROUTES)
+    routes = set()
+    for route in server.app.routes:
+        for method in getattr(route, "methods", None) or []:
+            if method != "HEAD" and route.path.startswith("/api"):
+                routes.add(f"{method} {route.path}")
+    return sorted(routes - covered)
+
+
+# ============= RUNNER =============
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+async def run_scenario(http, fixtures, scenario, requests, concurrency):
+    route, method, path, build = scenario
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            kwargs = build(fixtures, n) if build else {}
+            started = time.perf_counter()
+            response = await http.request(method, path(fixtures, n), **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": round(requests / wall, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def compare(route, result, baseline, threshold):
+    """Return a description of the regression, or None"""
+    before = baseline.get("routes", {}).get(route)
+    if not before:
+        return None
+    if result["p95_ms"] > before["p95_ms"] * (1 + threshold):
+        return f"p95 {before['p95_ms']}ms -> {result['p95_ms']}ms"
+    if result["throughput"] < before["throughput"] * (1 - threshold):
+        return f"throughput {before['throughput']} -> {result['throughput']} req/s"
+    return None
+
+
+async def run(args):
+    if args.in_memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            print("✗ --in-memory needs mongomock-motor (pip install mongomock-motor)")
+            sys.exit(2)
+        server.mongo.use_client(AsyncMongoMockClient(tz_aware=True))
+
+    print("Seeding...")
+    await seed(server.db, args.reseed)
+    fixtures = await load_fixtures(server.db)
+
+    await server.typeahead_index.rebuild()
+    scenarios = [s for s in SCENARIOS if not args.only or s[0] in args.only]
+    for route in uncovered_routes():
+        print(f"! No scenario for {route}")
+
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    results = {}
+    regressions = []
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as http:
+        print(f"\n{'route':58} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for scenario in scenarios:
+            result = await run_scenario(http, fixtures, scenario, args.requests, args.concurrency)
+            results[scenario[0]] = result
+            regression = compare(scenario[0], result, baseline, args.threshold)
+            if regression is None and args.require_baseline and not args.update_baseline \
+                    and scenario[0] not in baseline.get("routes", {}):
+                regression = "not in the baseline"
+            if regression:
+                regressions.append((scenario[0], regression))
+            marker = "✗" if regression or result["errors"] else "✓"
+            print(f"{marker} {scenario[0]:56} {result['throughput']:8.1f} {result['p50_ms']:7.1f}ms "
+                  f"{result['p95_ms']:7.1f}ms {result['p99_ms']:7.1f}ms"
+                  + (f"  ({result['errors']} errors)" if result["errors"] else ""))
+
+    if args.update_baseline:
+        BASELINE_PATH.write_text(json.dumps({
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+            "machine": f"{platform.system()} {platform.machine()} / Python {platform.python_version()}",
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "volumes": VOLUMES,
+            "routes": {**baseline.get("routes", {}), **results},
+        }, indent=2) + "\n")
+        print(f"\n✓ Baseline written to {BASELINE_PATH}")
+        return True
+
+    if not baseline:
+        if args.require_baseline:
+            print(f"\n✗ No baseline at {BASELINE_PATH}; record one with --update-baseline")
+            return False
+        print("\n! No baseline yet; run with --update-baseline to record one")
+        return True
+    for route, regression in regressions:
+        print(f"✗ {route}: {regression}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--only", action="append", help="route to run, e.g. 'GET /api/orders' (repeatable)")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of mongod")
+    parser.add_argument("--reseed", action="store_true", help="drop and re-seed the benchmark database")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--require-baseline", action="store_true", default=bool(os.environ.get("CI")),
+                        help="fail when there is no baseline to compare with (default when CI is set)")
+    args = parser.parse_args()
+
+    random.seed(1234)
+    ok = asyncio.run(run(args))
+    if not ok:
+        print("\n✗ Some routes regressed beyond the threshold or have no baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
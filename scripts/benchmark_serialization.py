@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Compare the default and fast response paths for 1k-row order and product pages
+
+Runs in-process against synthetic rows shaped like documents read from MongoDB,
+so it needs no database: the default path returns the dicts through
+response_model validation as the routes do, the fast path encodes them with
+FastJSONResponse as routes listed in FAST_RESPONSE_ROUTES do.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import statistics
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from server import (  # noqa: E402
+    FastJSONResponse, Order, OrderPage, Product, ProductPage, orjson, trusted_rows,
+)
+
+
+def order_rows(count):
+    now = datetime.now(timezone.utc)
+    return [{
+        "id": str(uuid.uuid4()),
+        "customer_name": f"Customer {n}",
+        "customer_email": f"customer{n}@example.com",
+        "customer_phone": "0712345678",
+        "items": [
+            {"product_id": str(uuid.uuid4()), "product_name": "Professional Chess Board", "quantity": 1, "price": 3500.0},
+            {"product_id": str(uuid.uuid4()), "product_name": "Digital Chess Clock", "quantity": 2, "price": 2800.0},
+        ],
+        "total_amount": 9100.0,
+        "status": "pending",
+        "mpesa_reference": None,
+        "mpesa_checkout_request_id": None,
+        "created_at": now - timedelta(minutes=n),
+    } for n in range(count)]
+
+
+def product_rows(count):
+    now = datetime.now(timezone.utc)
+    return [{
+        "id": str(uuid.uuid4()),
+        "name": f"Chess Set {n}",
+        "description": "Colorful chess set with large pieces, perfect for young learners",
+        "category": "chess_board",
+        "price": 1500.0,
+        "image_url": "https://images.pexels.com/photos/7104222/pexels-photo-7104222.jpeg",
+        "stock": 25,
+        "is_active": True,
+        "created_at": now - timedelta(minutes=n),
+    } for n in range(count)]
+
+
+def build_app(orders, products):
+    app = FastAPI()
+
+    @app.get("/default/orders", response_model=OrderPage)
+    async def default_orders():
+        return {"items": orders, "next_cursor": None}
+
+    @app.get("/fast/orders", response_model=OrderPage)
+    async def fast_orders():
+        return FastJSONResponse({"items": trusted_rows(Order, orders), "next_cursor": None})
+
+    @app.get("/default/products", response_model=ProductPage)
+    async def default_products():
+        return {"items": products, "next_cursor": None}
+
+    @app.get("/fast/products", response_model=ProductPage)
+    async def fast_products():
+        return FastJSONResponse({"items": trusted_rows(Product, products), "next_cursor": None})
+
+    return app
+
+
+def measure(client, path, iterations):
+    client.get(path)  # warm up
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return statistics.median(timings) * 1000, len(response.content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    client = TestClient(build_app(order_rows(args.rows), product_rows(args.rows)))
+    print(f"{args.rows} rows per page, median of {args.iterations} requests, "
+          f"encoder: {'orjson' if orjson else 'json (install orjson for the full gain)'}\n")
+    print(f"{'route':22} {'default':>10} {'fast':>10} {'speedup':>8}")
+
+    for route in ("orders", "products"):
+        default_ms, default_size = measure(client, f"/default/{route}", args.iterations)
+        fast_ms, fast_size = measure(client, f"/fast/{route}", args.iterations)
+        print(f"GET /api/{route:13} {default_ms:8.1f}ms {fast_ms:8.1f}ms {default_ms / fast_ms:7.1f}x"
+              f"   ({default_size // 1024} KB vs {fast_size // 1024} KB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Run orders through the full M-Pesa checkout cycle against the fake Daraja server
+
+Start scripts/fake_daraja.py, run the backend with MPESA_BASE_URL pointing at it,
+MPESA_CALLBACK_URL pointing back at the backend's /api/mpesa/callback and any
+MPESA_CALLBACK_TOKEN, then:
+
+    python3 scripts/check_mpesa_cycle.py --orders 200 --concurrency 20
+
+Each order is created, sent an STK push and polled until the callback marks it
+paid. Exits non-zero if any order is not paid in time or if the backend fetched
+more than one OAuth token.
+"""
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BACKEND_URL = "http://localhost:8001/api"
+DARAJA_URL = "http://localhost:8090"
+
+_local = threading.local()
+
+
+def session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def pick_product():
+    page = requests.get(f"{BACKEND_URL}/products", params={"limit": 200}).json()
+    in_stock = [product for product in page["items"] if product["stock"] > 0]
+    if not in_stock:
+        print("✗ No product in stock; run scripts/seed_data.py first")
+        sys.exit(1)
+    return max(in_stock, key=lambda product: product["stock"])
+
+
+def checkout(n, product, timeout):
+    started = time.perf_counter()
+    response = session().post(f"{BACKEND_URL}/orders", json={
+        "customer_name": f"Cycle check {n}",
+        "customer_email": f"cycle{n}@example.com",
+        "customer_phone": "0712345678",
+        "items": [{"product_id": product["id"], "quantity": 1}],
+    })
+    if response.status_code != 200:
+        return f"order {response.status_code}", 0
+    order_id = response.json()["id"]
+
+    response = session().post(f"{BACKEND_URL}/mpesa/stk-push",
+                              params={"phone_number": "0712345678", "order_id": order_id})
+    if response.status_code != 200:
+        return f"stk-push {response.status_code}", 0
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        order = session().get(f"{BACKEND_URL}/orders/{order_id}").json()
+        if order["status"] == "paid":
+            return "paid", time.perf_counter() - started
+        time.sleep(0.2)
+    return "timeout", 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each order to be paid")
+    args = parser.parse_args()
+
+    before = requests.get(f"{DARAJA_URL}/__stats").json()
+    product = pick_product()
+    print(f"Checking out {args.orders} orders of {product['name']} over {args.concurrency} threads")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda n: checkout(n, product, args.timeout), range(args.orders)))
+    wall = time.perf_counter() - started
+    after = requests.get(f"{DARAJA_URL}/__stats").json()
+
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    cycle_times = sorted(elapsed for outcome, elapsed in results if outcome == "paid")
+
+    print(f"\n{wall:.1f}s total")
+    if cycle_times:
+        print(f"checkout-to-paid p50 {cycle_times[len(cycle_times) // 2]:.2f}s, max {cycle_times[-1]:.2f}s")
+    for outcome, count in sorted(outcomes.items()):
+        print(f"  {outcome:14} {count}")
+
+    tokens = after["tokens_issued"] - before["tokens_issued"]
+    pushes = after["stk_pushes"] - before["stk_pushes"]
+    print(f"\nFake Daraja: {pushes} STK pushes, {tokens} OAuth tokens issued")
+
+    if outcomes.get("paid", 0) != args.orders or tokens > 1:
+        print("✗ Cycle check failed")
+        sys.exit(1)
+    print("✓ Every order was paid")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Report the query plan for every API route and fail if any still does a COLLSCAN
+"""
+import sys
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import db, ensure_indexes, explain_query_shapes  # noqa: E402
+
+
+async def check_query_plans(create_indexes):
+    if create_indexes:
+        print("Creating indexes...")
+        await ensure_indexes(db)
+
+    report = await explain_query_shapes(db)
+    for entry in report:
+        if entry["collscan"]:
+            marker = "✗ COLLSCAN"
+        elif entry["in_memory_sort"]:
+            marker = "! SORT"
+        else:
+            marker = "✓"
+        print(f"{marker:12} {entry['route']:45} {' <- '.join(entry['stages'])}")
+
+    return not any(entry["collscan"] for entry in report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--create-indexes", action="store_true", help="apply the declared index spec first")
+    args = parser.parse_args()
+
+    ok = asyncio.run(check_query_plans(args.create_indexes))
+    if not ok:
+        print("\n✗ Some routes still scan a whole collection")
+        sys.exit(1)
+    print("\n✓ Every route query uses an index")
+
+
+if __name__ == "__main__":
+    main()
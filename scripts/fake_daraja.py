@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Safaricom Daraja API
+
+Implements the OAuth token and STK push endpoints the backend uses, then posts a
+payment callback to the request's CallBackURL after a short delay, so the whole
+checkout -> STK push -> callback -> paid cycle can run offline. Point the backend
+at it with MPESA_BASE_URL=http://localhost:8090.
+
+GET /__stats reports how many tokens and pushes were served, which is how a load
+test confirms the backend is caching its token and reusing connections.
+"""
+import asyncio
+import argparse
+import base64
+import random
+import secrets
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Request
+
+app = FastAPI(title="Fake Daraja")
+
+settings = {"token_ttl": 3599, "callback_delay": 0.5, "failure_rate": 0.0, "passkey": None}
+tokens = {}
+stats = {"tokens_issued": 0, "stk_pushes": 0, "callbacks_sent": 0, "callbacks_failed": 0}
+callback_client = None
+
+
+@app.on_event("startup")
+async def open_callback_client():
+    global callback_client
+    callback_client = httpx.AsyncClient(timeout=10)
+
+
+@app.on_event("shutdown")
+async def close_callback_client():
+    await callback_client.aclose()
+
+
+@app.get("/oauth/v1/generate")
+async def generate_token(grant_type: str, authorization: str = Header(None)):
+    if grant_type != "client_credentials" or not (authorization or "").startswith("Basic "):
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+
+    token = secrets.token_urlsafe(24)
+    tokens[token] = time.monotonic() + settings["token_ttl"]
+    stats["tokens_issued"] += 1
+    return {"access_token": token, "expires_in": str(settings["token_ttl"])}
+
+
+@app.post("/mpesa/stkpush/v1/processrequest")
+async def stk_push(request: Request, authorization: str = Header(None)):
+    token = (authorization or "").removeprefix("Bearer ")
+    if tokens.get(token, 0) < time.monotonic():
+        raise HTTPException(status_code=401, detail="Invalid Access Token")
+
+    body = await request.json()
+    if settings["passkey"]:
+        expected = base64.b64encode(
+            f"{body['BusinessShortCode']}{settings['passkey']}{body['Timestamp']}".encode()
+        ).decode()
+        if body["Password"] != expected:
+            raise HTTPException(status_code=400, detail="Invalid Password")
+
+    stats["stk_pushes"] += 1
+    checkout_request_id = f"ws_CO_{datetime.now():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}"
+    merchant_request_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+    asyncio.create_task(send_callback(body, merchant_request_id, checkout_request_id))
+
+    return {
+        "MerchantRequestID": merchant_request_id,
+        "CheckoutRequestID": checkout_request_id,
+        "ResponseCode": "0",
+        "ResponseDescription": "Success. Request accepted for processing",
+        "CustomerMessage": "Success. Request accepted for processing",
+    }
+
+
+@app.get("/__stats")
+async def get_stats():
+    return stats
+
+
+async def send_callback(body, merchant_request_id, checkout_request_id):
+    await asyncio.sleep(settings["callback_delay"])
+
+    callback = {
+        "MerchantRequestID": merchant_request_id,
+        "CheckoutRequestID": checkout_request_id,
+    }
+    if random.random() < settings["failure_rate"]:
+        callback.update({"ResultCode": 1032, "ResultDesc": "Request cancelled by user"})
+    else:
+        callback.update({
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": body["Amount"]},
+                {"Name": "MpesaReceiptNumber", "Value": secrets.token_hex(5).upper()},
+                {"Name": "TransactionDate", "Value": int(f"{datetime.now():%Y%m%d%H%M%S}")},
+                {"Name": "PhoneNumber", "Value": int(body["PhoneNumber"])},
+            ]},
+        })
+
+    try:
+        response = await callback_client.post(body["CallBackURL"], json={"Body": {"stkCallback": callback}})
+        response.raise_for_status()
+        stats["callbacks_sent"] += 1
+    except httpx.HTTPError as e:
+        stats["callbacks_failed"] += 1
+        print(f"✗ Callback for {checkout_request_id} failed: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--passkey", help="check STK push passwords against this passkey")
+    parser.add_argument("--token-ttl", type=int, default=3599, help="seconds an access token is valid")
+    parser.add_argument("--callback-delay", type=float, default=0.5, help="seconds before the callback is sent")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of payments the customer cancels")
+    args = parser.parse_args()
+
+    settings.update(token_ttl=args.token_ttl, callback_delay=args.callback_delay,
+                    failure_rate=args.failure_rate, passkey=args.passkey)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Convert ISO-string timestamps to native BSON dates
+
+Safe to interrupt and re-run: only documents that still hold string dates are
+selected, so a restarted run picks up where the previous one stopped.
+"""
+import sys
+import asyncio
+import argparse
+from pathlib import Path
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import db, DATE_FIELDS  # noqa: E402
+
+
+def parse_date(value):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+async def migrate_collection(name, fields, batch_size, dry_run):
+    collection = db[name]
+    string_dates = {"$or": [{field: {"$type": "string"}} for field in fields]}
+    projection = {field: 1 for field in fields}
+
+    converted = 0
+    failed = 0
+    last_id = None
+    while True:
+        query = string_dates if last_id is None else {"$and": [string_dates, {"_id": {"$gt": last_id}}]}
+        docs = await collection.find(query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            break
+
+        operations = []
+        for doc in docs:
+            updates = {}
+            for field in fields:
+                if isinstance(doc.get(field), str):
+                    try:
+                        updates[field] = parse_date(doc[field])
+                    except ValueError:
+                        failed += 1
+            if updates:
+                operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": updates}))
+
+        if operations and not dry_run:
+            await collection.bulk_write(operations, ordered=False)
+        converted += len(operations)
+        last_id = docs[-1]["_id"]
+        print(f"  {name}: {converted} converted", end="\r")
+
+    status = "✓" if not failed else "✗"
+    print(f"{status} {name}: {converted} documents converted, {failed} unparseable values left as strings")
+
+
+async def migrate(batch_size, dry_run):
+    for name, fields in DATE_FIELDS.items():
+        await migrate_collection(name, fields, batch_size, dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="count documents without writing")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Kashoe Chess Club - Migrating string dates to BSON dates")
+    print("=" * 60)
+    asyncio.run(migrate(args.batch_size, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Lower-case stored newsletter emails and merge subscribers that differ only by case
+
+Subscribers saved before emails were normalized can differ only by case or
+whitespace, which the case-sensitive unique index on email lets through. Run this
+before deploying the unique index. Within each group the subscriber already in
+lower case (or else the earliest) is kept, with the earliest subscribed_at, and
+stays active if any of the group was. Safe to re-run; clean data is left alone.
+"""
+import sys
+import asyncio
+import argparse
+from pathlib import Path
+from datetime import datetime, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import db, as_utc  # noqa: E402
+
+NEVER = datetime.max.replace(tzinfo=timezone.utc)
+
+
+def subscribed(doc):
+    value = doc.get("subscribed_at")
+    return as_utc(value) if isinstance(value, datetime) else NEVER
+
+
+async def find_groups():
+    """Subscribers grouped by normalized email, keeping only groups that need a change."""
+    return await db.newsletter_subscriptions.aggregate([
+        {"$group": {
+            "_id": {"$toLower": {"$trim": {"input": "$email"}}},
+            "docs": {"$push": {"_id": "$_id", "email": "$email", "subscribed_at": "$subscribed_at", "is_active": "$is_active"}},
+        }},
+        {"$match": {"$expr": {"$or": [
+            {"$gt": [{"$size": "$docs"}, 1]},
+            {"$ne": [{"$arrayElemAt": ["$docs.email", 0]}, "$_id"]},
+        ]}}},
+    ], allowDiskUse=True).to_list(None)
+
+
+async def merge_group(email, docs):
+    """Merge one group into a single subscriber; returns the number of documents removed."""
+    keep = min(docs, key=lambda doc: (doc.get("email") != email, subscribed(doc)))
+    duplicates = [doc["_id"] for doc in docs if doc["_id"] != keep["_id"]]
+    # Delete first: the survivor can't take the normalized email while a duplicate holds it
+    removed = 0
+    if duplicates:
+        removed = (await db.newsletter_subscriptions.delete_many({"_id": {"$in": duplicates}})).deleted_count
+
+    merged = {"is_active": any(doc.get("is_active", True) for doc in docs)}
+    earliest = min(subscribed(doc) for doc in docs)
+    if earliest != NEVER:
+        merged["subscribed_at"] = earliest
+    try:
+        await db.newsletter_subscriptions.update_one({"_id": keep["_id"]}, {"$set": {"email": email, **merged}})
+    except DuplicateKeyError:
+        # The app subscribed the normalized email meanwhile; fold the survivor into that one
+        fold = {"$max": {"is_active": merged["is_active"]}}
+        if "subscribed_at" in merged:
+            fold["$min"] = {"subscribed_at": merged["subscribed_at"]}
+        await db.newsletter_subscriptions.update_one({"email": email}, fold)
+        await db.newsletter_subscriptions.delete_one({"_id": keep["_id"]})
+        removed += 1
+    return removed
+
+
+async def normalize(dry_run):
+    groups = [group for group in await find_groups() if group["_id"]]
+    duplicates = sum(len(group["docs"]) - 1 for group in groups)
+    if dry_run:
+        print(f"✓ {len(groups)} emails need normalizing, {duplicates} duplicate subscribers would be merged")
+        return
+
+    removed = 0
+    for done, group in enumerate(groups, 1):
+        removed += await merge_group(group["_id"], group["docs"])
+        print(f"  {done}/{len(groups)} emails normalized", end="\r")
+    print(f"✓ {len(groups)} emails normalized, {removed} duplicate subscribers merged")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="count affected subscribers without writing")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Kashoe Chess Club - Normalizing newsletter emails")
+    print("=" * 60)
+    asyncio.run(normalize(args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
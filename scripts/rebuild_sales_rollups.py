@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Recompute the sales_daily rollup from every order
+
+The API keeps sales_daily up to date as order statuses change; run this after
+importing orders directly into the database, or if the rollup is suspected to
+have drifted. It replaces the collection with the output of one aggregation.
+"""
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import db, rebuild_sales_rollups  # noqa: E402
+
+
+async def rebuild():
+    started = time.perf_counter()
+    await rebuild_sales_rollups(db)
+    rows = await db.sales_daily.count_documents({})
+    print(f"✓ sales_daily rebuilt: {rows} day/category rows in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__.strip().splitlines()[0]).parse_args()
+    asyncio.run(rebuild())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,46 @@
 """
 Seed sample data for Kashoe Chess Club
 """
+import argparse
 import requests
-import json
 from datetime import datetime, timedelta
 
 BACKEND_URL = "http://localhost:8001/api"
+BULK_CHUNK_SIZE = 1000  # matches MAX_BULK_SIZE in backend/server.py
 
-def seed_products():
+
+def bulk_post(session, path, items, label):
+    """POST items to a bulk endpoint in chunks over one pooled connection"""
+    added = 0
+    for start in range(0, len(items), BULK_CHUNK_SIZE):
+        chunk = items[start:start + BULK_CHUNK_SIZE]
+        try:
+            response = session.post(f"{BACKEND_URL}{path}", json=chunk)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"✗ Error adding {label} {start}-{start + len(chunk) - 1}: {e}")
+            continue
+
+        result = response.json()
+        added += len(result["inserted"])
+        for error in result["errors"]:
+            item = chunk[error["index"]]
+            print(f"✗ Failed to add: {item.get('name') or item.get('title')} ({error['detail']})")
+
+    print(f"✓ Added {added} of {len(items)} {label}")
+
+
+def repeat(items, copies, key):
+    """Duplicate the sample rows to build a larger data set for load testing"""
+    if copies <= 1:
+        return items
+    return [
+        {**item, key: f"{item[key]} #{copy + 1}"}
+        for copy in range(copies)
+        for item in items
+    ]
+
+def seed_products(session, copies=1):
     """Add sample products"""
     products = [
         {
@@ -89,17 +122,9 @@ def seed_products():
     ]
     
     print("Seeding products...")
-    for product in products:
-        try:
-            response = requests.post(f"{BACKEND_URL}/products", json=product)
-            if response.status_code == 200:
-                print(f"✓ Added: {product['name']}")
-            else:
-                print(f"✗ Failed to add: {product['name']}")
-        except Exception as e:
-            print(f"✗ Error adding {product['name']}: {e}")
+    bulk_post(session, "/products/bulk", repeat(products, copies, "name"), "products")
 
-def seed_events():
+def seed_events(session, copies=1):
     """Add sample events"""
     today = datetime.now()
     events = [
@@ -142,23 +167,20 @@ def seed_events():
     ]
     
     print("\nSeeding events...")
-    for event in events:
-        try:
-            response = requests.post(f"{BACKEND_URL}/events", json=event)
-            if response.status_code == 200:
-                print(f"✓ Added: {event['title']}")
-            else:
-                print(f"✗ Failed to add: {event['title']}")
-        except Exception as e:
-            print(f"✗ Error adding {event['title']}: {e}")
+    bulk_post(session, "/events/bulk", repeat(events, copies, "title"), "events")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed sample data for Kashoe Chess Club")
+    parser.add_argument("--copies", type=int, default=1, help="repeat the sample data N times")
+    args = parser.parse_args()
+
     print("=" * 60)
     print("Kashoe Chess Club - Seeding Sample Data")
     print("=" * 60)
     
-    seed_products()
-    seed_events()
+    with requests.Session() as session:
+        seed_products(session, args.copies)
+        seed_events(session, args.copies)
     
     print("\n" + "=" * 60)
     print("Seeding complete!")
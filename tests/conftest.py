@@ -0,0 +1,58 @@
+"""
+Shared fixtures for the backend tests.
+
+Tests run against the MongoDB at TEST_MONGO_URL when it is set (a throwaway
+database is created and dropped per test), otherwise against mongomock-motor.
+They are skipped when neither is available.
+"""
+import os
+import sys
+import uuid
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+os.environ.setdefault("MONGO_URL", os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017"))
+os.environ.setdefault("DB_NAME", "kashoe_test")
+
+
+@pytest.fixture(scope="session")
+def server():
+    pytest.importorskip("fastapi")
+    pytest.importorskip("motor")
+    import server as module
+    return module
+
+
+def _client():
+    if os.environ.get("TEST_MONGO_URL"):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(os.environ["TEST_MONGO_URL"], tz_aware=True)
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    return mongomock_motor.AsyncMongoMockClient(tz_aware=True)
+
+
+@pytest.fixture
+def run(server, monkeypatch):
+    """
+    run(scenario) calls the async scenario(db) on a fresh database in its own event
+    loop, with the server module pointed at that database.
+    """
+    monkeypatch.setenv("DB_NAME", f"kashoe_test_{uuid.uuid4().hex[:8]}")
+
+    def run_scenario(scenario):
+        async def main():
+            client = _client()
+            server.mongo.use_client(client)
+            try:
+                return await scenario(server.db)
+            finally:
+                await client.drop_database(os.environ["DB_NAME"])
+                server.mongo.close()
+
+        return asyncio.run(main())
+
+    return run_scenario
@@ -0,0 +1,48 @@
+def test_stock_change_drops_only_entries_showing_that_product(server):
+    cache = server.CatalogCache(ttl_seconds=60)
+    cache.put(("product", "a"), b"a", cache.checkpoint(), ["a"])
+    cache.put(("product", "b"), b"b", cache.checkpoint(), ["b"])
+    cache.put(("products", "page"), b"a,b", cache.checkpoint(), ["a", "b"])
+    cache.put(("products", "names"), b"a,b", cache.checkpoint())
+
+    cache.invalidate_stock({"a"})
+
+    assert cache.get(("product", "a")) is None
+    assert cache.get(("products", "page")) is None
+    assert cache.get(("product", "b")) is not None
+    assert cache.get(("products", "names")) is not None
+
+
+def test_entry_built_across_a_stock_change_is_not_kept(server):
+    cache = server.CatalogCache(ttl_seconds=60)
+    checkpoint = cache.checkpoint()
+    cache.invalidate_stock({"a"})
+
+    cache.put(("product", "a"), b"old", checkpoint, ["a"])
+    cache.put(("product", "b"), b"b", checkpoint, ["b"])
+
+    assert cache.get(("product", "a")) is None
+    assert cache.get(("product", "b")) is not None
+
+
+def test_catalog_write_drops_everything(server):
+    cache = server.CatalogCache(ttl_seconds=60)
+    checkpoint = cache.checkpoint()
+    cache.put(("products", "names"), b"a,b", checkpoint)
+
+    cache.invalidate()
+    cache.put(("product", "a"), b"old", checkpoint, ["a"])
+
+    assert cache.get(("products", "names")) is None
+    assert cache.get(("product", "a")) is None
+
+
+def test_etag_depends_only_on_the_body(server):
+    # Two workers with different invalidation histories tag the same body alike
+    fresh = server.CatalogCache(ttl_seconds=60)
+    busy = server.CatalogCache(ttl_seconds=60)
+    busy.invalidate()
+    busy.invalidate()
+
+    assert fresh.put("key", b"body", fresh.checkpoint())[0] == busy.put("key", b"body", busy.checkpoint())[0]
+    assert fresh.put("key", b"body", fresh.checkpoint())[0] != fresh.put("key", b"other", fresh.checkpoint())[0]
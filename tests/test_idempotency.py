@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+
+def make_payload(server, **overrides):
+    fields = {"customer_name": "Amina", "customer_email": "amina@example.com", "customer_phone": "254700000000",
+              "items": [{"product_id": "a", "quantity": 1}]}
+    fields.update(overrides)
+    return server.OrderCreate(**fields)
+
+
+def test_retry_replays_the_stored_response(server, run):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        return server.OrderItem(product_id="a", product_name="Board", quantity=len(calls), price=100)
+
+    async def scenario(db):
+        payload = make_payload(server)
+        first = await server.run_idempotent("key-1", "orders", payload, handler)
+        second = await server.run_idempotent("key-1", "orders", payload, handler)
+        return first, second
+
+    first, second = run(scenario)
+    assert calls == [1]
+    assert second.body == first.body
+    assert json.loads(second.body)["quantity"] == 1
+    assert second.headers["Idempotent-Replayed"] == "true"
+
+
+def test_reusing_a_key_with_a_different_request_is_rejected(server, run):
+    async def handler():
+        return server.OrderItem(product_id="a", product_name="Board", quantity=1, price=100)
+
+    async def scenario(db):
+        await server.run_idempotent("key-1", "orders", make_payload(server), handler)
+        with pytest.raises(server.HTTPException) as excinfo:
+            await server.run_idempotent("key-1", "orders", make_payload(server, customer_name="Baraka"), handler)
+        return excinfo.value
+
+    assert run(scenario).status_code == 422
+
+
+def test_failed_handler_releases_the_key_for_a_retry(server, run):
+    attempts = []
+
+    async def handler():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise server.HTTPException(status_code=409, detail="Insufficient stock: Board")
+        return server.OrderItem(product_id="a", product_name="Board", quantity=1, price=100)
+
+    async def scenario(db):
+        payload = make_payload(server)
+        with pytest.raises(server.HTTPException):
+            await server.run_idempotent("key-1", "orders", payload, handler)
+        released = await db.idempotency_keys.count_documents({})
+        response = await server.run_idempotent("key-1", "orders", payload, handler)
+        return released, response
+
+    released, response = run(scenario)
+    assert released == 0
+    assert len(attempts) == 2
+    assert "Idempotent-Replayed" not in response.headers
+
+
+def test_keys_are_scoped(server, run):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        return server.OrderItem(product_id="a", product_name="Board", quantity=1, price=100)
+
+    async def scenario(db):
+        payload = make_payload(server)
+        await server.run_idempotent("key-1", "orders", payload, handler)
+        await server.run_idempotent("key-1", "lessons", payload, handler)
+
+    run(scenario)
+    assert len(calls) == 2
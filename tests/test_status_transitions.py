@@ -0,0 +1,68 @@
+from datetime import datetime, timezone
+
+
+CREATED = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+
+
+def order(order_id, status, quantity=1):
+    return {
+        "id": order_id,
+        "status": status,
+        "created_at": CREATED,
+        "stock_reserved": True,
+        "items": [{"product_id": "a", "product_name": "Board", "quantity": quantity, "price": 100, "category": "boards"}],
+    }
+
+
+def test_bulk_order_cancel_counts_and_side_effects(server, run):
+    Status = server.OrderStatus
+
+    async def scenario(db):
+        await db.products.insert_one({"id": "a", "stock": 0})
+        paid = order("paid", Status.PAID.value, quantity=4)
+        await db.orders.insert_many([
+            order("pending-1", Status.PENDING.value, quantity=1),
+            order("pending-2", Status.PENDING.value, quantity=2),
+            paid,
+            order("shipped", Status.SHIPPED.value, quantity=8),
+            order("cancelled", Status.CANCELLED.value, quantity=16),
+        ])
+        await server.update_sales_rollups([paid], 1)
+
+        ids = ["pending-1", "pending-2", "paid", "shipped", "cancelled", "missing"]
+        result = await server.bulk_transition(
+            db.orders, server.bulk_status_query(ids, None), Status.CANCELLED, server.ORDER_TRANSITIONS,
+            ids=ids, orders=True
+        )
+        statuses = {doc["id"]: doc["status"] for doc in await db.orders.find({}, {"_id": 0}).to_list(None)}
+        stock = (await db.products.find_one({"id": "a"}))["stock"]
+        units = sum(doc["units"] for doc in await db.sales_daily.find({}).to_list(None))
+        return result, statuses, stock, units
+
+    result, statuses, stock, units = run(scenario)
+    assert result == {"matched": 4, "modified": 3, "rejected": 1, "not_found": 1}
+    assert statuses["shipped"] == Status.SHIPPED.value
+    assert all(status == Status.CANCELLED.value for order_id, status in statuses.items() if order_id != "shipped")
+    # Only the three orders this call cancelled give their stock back
+    assert stock == 1 + 2 + 4
+    # The paid order leaves the sales rollup
+    assert units == 0
+
+
+def test_bulk_transition_by_filter(server, run):
+    Status = server.LessonStatus
+
+    async def scenario(db):
+        await db.lesson_registrations.insert_many([
+            {"id": "pending", "status": Status.PENDING.value, "created_at": CREATED},
+            {"id": "approved", "status": Status.APPROVED.value, "created_at": CREATED},
+            {"id": "old", "status": Status.PENDING.value, "created_at": datetime(2025, 1, 1, tzinfo=timezone.utc)},
+        ])
+        status_filter = server.LessonStatusFilter(created_from=datetime(2026, 1, 1))
+        return await server.bulk_transition(
+            db.lesson_registrations, server.bulk_status_query(None, status_filter), Status.APPROVED,
+            server.LESSON_TRANSITIONS
+        )
+
+    # "approved" already is the target: matched but not modified; "old" is outside the range
+    assert run(scenario) == {"matched": 2, "modified": 1, "rejected": 0, "not_found": 0}
@@ -0,0 +1,68 @@
+import pytest
+
+
+def line(server, product_id, quantity):
+    return server.OrderItem(product_id=product_id, product_name=product_id, quantity=quantity, price=100)
+
+
+async def seed_products(db, stock):
+    await db.products.create_index("id", unique=True)
+    await db.products.insert_many([{"id": product_id, "stock": count} for product_id, count in stock.items()])
+
+
+async def stock_of(db):
+    return {doc["id"]: doc["stock"] for doc in await db.products.find({}, {"_id": 0}).to_list(None)}
+
+
+def test_reserve_stock_decrements_every_line(server, run):
+    async def scenario(db):
+        await seed_products(db, {"a": 5, "b": 3})
+        await server.reserve_stock([line(server, "a", 2), line(server, "b", 3)])
+        return await stock_of(db)
+
+    assert run(scenario) == {"a": 3, "b": 0}
+
+
+def test_reserve_stock_puts_back_earlier_lines_when_one_is_short(server, run):
+    async def scenario(db):
+        await seed_products(db, {"a": 5, "b": 1, "c": 4})
+        with pytest.raises(server.HTTPException) as excinfo:
+            await server.reserve_stock([line(server, "a", 2), line(server, "b", 2), line(server, "c", 1)])
+        return excinfo.value, await stock_of(db)
+
+    error, stock = run(scenario)
+    assert error.status_code == 409
+    assert "b" in error.detail
+    # Nothing stayed reserved
+    assert stock == {"a": 5, "b": 1, "c": 4}
+
+
+def test_reserve_stock_rejects_unknown_products_without_creating_them(server, run):
+    async def scenario(db):
+        await seed_products(db, {"a": 5})
+        with pytest.raises(server.HTTPException):
+            await server.reserve_stock([line(server, "a", 1), line(server, "missing", 1)])
+        return await stock_of(db)
+
+    assert run(scenario) == {"a": 5}
+
+
+def test_restock_orders_merges_quantities_per_product(server, run):
+    async def scenario(db):
+        await seed_products(db, {"a": 0, "b": 0})
+        await server.restock_orders([
+            {"stock_reserved": True, "items": [{"product_id": "a", "quantity": 2}, {"product_id": "b", "quantity": 1}]},
+            {"stock_reserved": True, "items": [{"product_id": "a", "quantity": 3}]},
+        ])
+        return await stock_of(db)
+
+    assert run(scenario) == {"a": 5, "b": 1}
+
+
+def test_restock_orders_skips_orders_that_never_reserved_stock(server, run):
+    async def scenario(db):
+        await seed_products(db, {"a": 0})
+        await server.restock_orders([{"items": [{"product_id": "a", "quantity": 2}]}])
+        return await stock_of(db)
+
+    assert run(scenario) == {"a": 0}